@@ -0,0 +1,2 @@
+# Benchmarks for hylat. roster makes synthetic rosters of any size and run times every
+# team making mode on them, see README.md
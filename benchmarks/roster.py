@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+""" Synthetic rosters for benchmarking hylat.py
+
+Writes a roster in the people.txt format with an exact number of people. Family sizes are
+drawn from a distribution (fixed, uniform or geometric) and each person's category from a
+zipf-like skew over the categories, so skew 0 spreads people evenly and larger values pile
+them into the first categories. Names are Cat<category>_<person>_<family> like the test
+files use. """
+
+import sys
+import argparse
+import numpy as np
+
+
+DISTRIBUTIONS = ('fixed', 'uniform', 'geometric')
+
+# Returns the size of every family, summing to exactly people_count
+def family_sizes(people_count, distribution, mean_size, rng):
+    mean_size = max(mean_size, 1)
+    draw = int(people_count // mean_size) + 1
+    sizes = np.empty(0, dtype=np.int64)
+    while sizes.sum() < people_count:
+        if distribution == 'fixed':
+            more = np.full(draw, round(mean_size))
+        elif distribution == 'uniform':
+            more = rng.integers(1, 2 * round(mean_size), draw, endpoint=False)
+        else:
+            more = rng.geometric(1 / mean_size, draw)
+        sizes = np.concatenate((sizes, np.maximum(more, 1)))
+
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), people_count) + 1]
+    sizes[-1] -= sizes.sum() - people_count
+    return sizes[sizes > 0]
+
+def category_weights(category_count, skew):
+    weights = 1 / np.arange(1, category_count + 1) ** skew
+    return weights / weights.sum()
+
+# Yields the roster one family line at a time
+def roster_lines(people_count, distribution='geometric', mean_size=3, category_count=2, skew=0.0, seed=None):
+    rng = np.random.default_rng(seed)
+    sizes = family_sizes(people_count, distribution, mean_size, rng)
+    cats = rng.choice(category_count, people_count, p=category_weights(category_count, skew))
+
+    person = 0
+    for fam, size in enumerate(sizes.tolist()):
+        members = [[] for _ in range(category_count)]
+        for cat in cats[person:person + size].tolist():
+            members[cat].append(f'Cat{cat}_{person}_{fam}')
+            person += 1
+        yield ' : '.join(', '.join(names) for names in members)
+
+def write_roster(out, people_count, **options):
+    for line in roster_lines(people_count, **options):
+        out.write(line)
+        out.write('\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a synthetic roster for benchmarking hylat.py')
+    parser.add_argument('people', type=int, help='number of people in the roster')
+    parser.add_argument('-f', '--families', default='geometric', choices=DISTRIBUTIONS, help='family size distribution (default is geometric)')
+    parser.add_argument('-m', '--mean-size', default=3, type=float, help='mean family size (default is 3)')
+    parser.add_argument('-c', '--categories', default=2, type=int, help='number of categories (default is 2)')
+    parser.add_argument('-k', '--skew', default=0.0, type=float, help='zipf exponent of category sizes, 0 is even (default is 0)')
+    parser.add_argument('--seed', default=None, type=int, help='seed so the same options give the same roster')
+    args = parser.parse_args()
+
+    write_roster(sys.stdout, args.people, distribution=args.families, mean_size=args.mean_size,
+                 category_count=args.categories, skew=args.skew, seed=args.seed)
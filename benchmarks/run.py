@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+""" Benchmark suite for hylat.py
+
+Times every mode (default, generations, uneven, drop and oktogether) on synthetic rosters of
+each requested size. Every run is its own python process reading the roster from a file,
+so the wall time covers parsing and imports and the peak memory is that process's maximum
+resident size. Each case repeats with different seeds to get a success rate, and the cold
+start of the command line tool (--help and a people.txt run) is timed as well. Results are
+written as json so runs from different versions can be compared. """
+
+import sys
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from statistics import median
+
+from benchmarks.roster import write_roster, DISTRIBUTIONS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# uneven and drop use a team size that usually does not divide the roster
+MODES = {
+    'default': {'teamsize': 4},
+    'generations': {'teamsize': 4, 'generations': True},
+    'uneven': {'teamsize': 3, 'uneven': True},
+    'drop': {'teamsize': 3, 'drop': True},
+    'oktogether': {'teamsize': 4, 'oktogether': True},
+}
+
+# Run in a child process: team one roster file and report the time, tries and peak memory
+CHILD = '''
+import sys, json, time, resource
+sys.path.insert(0, sys.argv[1])
+import hylat
+args = hylat.default_args()
+for name, value in json.loads(sys.argv[3]).items():
+    setattr(args, name, value)
+start = time.perf_counter()
+try:
+    with open(sys.argv[2], 'r') as people:
+        result = hylat.team_result(args, people)
+    report = {'ok': True, 'tries': result['tries'], 'repairs': result['repairs']}
+except ValueError as verr:
+    report = {'ok': False, 'error': str(verr)}
+report['seconds'] = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+report['peak_mb'] = rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+print(json.dumps(report))
+'''
+
+def run_case(roster_file, options, timeout):
+    start = time.perf_counter()
+    try:
+        child = subprocess.run([sys.executable, '-c', CHILD, ROOT, roster_file, json.dumps(options)],
+                               capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'ok': False, 'error': 'timeout', 'wall': timeout}
+
+    if child.returncode != 0:
+        return {'ok': False, 'error': child.stderr.strip().splitlines()[-1:], 'wall': time.perf_counter() - start}
+    report = json.loads(child.stdout)
+    report['wall'] = time.perf_counter() - start
+    return report
+
+def summarize(reports):
+    done = [r for r in reports if r['ok']]
+    summary = {'runs': len(reports), 'success_rate': len(done) / len(reports),
+               'wall_median': median(r['wall'] for r in reports)}
+    if done:
+        summary['teams_median'] = median(r['seconds'] for r in done)
+        summary['tries_median'] = median(r['tries'] for r in done)
+        summary['repairs_median'] = median(r['repairs'] for r in done)
+        summary['peak_mb_max'] = max(r['peak_mb'] for r in done)
+    errors = sorted({str(r['error']) for r in reports if not r['ok']})
+    if errors:
+        summary['errors'] = errors
+    return summary
+
+# wall time of a few hylat.py command lines, best of repeats, plus the import time of the
+# modules hylat.py loads itself (from -X importtime)
+def cold_start(repeats):
+    script = os.path.join(ROOT, 'hylat.py')
+    people = os.path.join(ROOT, 'people.txt')
+    commands = {'bare_python': [sys.executable, '-c', 'pass'],
+                'help': [sys.executable, script, '--help'],
+                'people': [sys.executable, script, '-s', '2', people]}
+
+    report = {}
+    for name, command in commands.items():
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        report[name] = best
+
+    trace = subprocess.run([sys.executable, '-X', 'importtime', script, '-s', '2', people],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    top = {}
+    for line in trace.splitlines():
+        parts = line.split('|')
+        # top level imports are the ones without indenting after the last bar
+        if len(parts) == 3 and parts[1].strip().isdigit() and not parts[2].startswith('  '):
+            top[parts[2].strip()] = int(parts[1]) / 1e6
+    report['imports'] = dict(sorted(top.items(), key=lambda item: -item[1])[:10])
+    return report
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark hylat.py on synthetic rosters')
+    parser.add_argument('-n', '--people', default='100,1000,10000', help='comma separated roster sizes (default is 100,1000,10000)')
+    parser.add_argument('-m', '--modes', default=','.join(MODES), help=f'comma separated modes from {", ".join(MODES)} (default is all)')
+    parser.add_argument('-f', '--families', default='geometric', choices=DISTRIBUTIONS, help='family size distribution (default is geometric)')
+    parser.add_argument('--mean-size', default=3, type=float, help='mean family size (default is 3)')
+    parser.add_argument('-c', '--categories', default=2, type=int, help='number of categories (default is 2)')
+    parser.add_argument('-k', '--skew', default=0.0, type=float, help='zipf exponent of category sizes, 0 is even (default is 0)')
+    parser.add_argument('-r', '--repeats', default=3, type=int, help='runs of each case, each with its own seed (default is 3)')
+    parser.add_argument('-e', '--engine', default=None, help='hylat engine to use (default is hylat\'s default)')
+    parser.add_argument('-t', '--timeout', default=600, type=float, help='seconds before a run is counted as failed (default is 600)')
+    parser.add_argument('-o', '--output', default=None, help='file for the json results (default is stdout)')
+    parser.add_argument('--no-cold-start', action='store_true', help='skip timing the command line start up')
+    args = parser.parse_args()
+
+    modes = args.modes.split(',')
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f'unknown mode {mode}')
+
+    results = {'version': version(), 'python': platform.python_version(), 'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'roster': {'families': args.families, 'mean_size': args.mean_size,
+                          'categories': args.categories, 'skew': args.skew},
+               'cases': []}
+    if not args.no_cold_start:
+        results['cold_start'] = cold_start(max(args.repeats, 5))
+
+    with tempfile.TemporaryDirectory() as temp:
+        for people_count in (int(float(n)) for n in args.people.split(',')):
+            roster_file = os.path.join(temp, f'roster_{people_count}.txt')
+            with open(roster_file, 'w') as out:
+                write_roster(out, people_count, distribution=args.families, mean_size=args.mean_size,
+                             category_count=args.categories, skew=args.skew, seed=people_count)
+
+            for mode in modes:
+                reports = []
+                for seed in range(args.repeats):
+                    options = dict(MODES[mode], seed=seed)
+                    if args.engine:
+                        options['engine'] = args.engine
+                    reports.append(run_case(roster_file, options, args.timeout))
+
+                case = dict(summarize(reports), people=people_count, mode=mode, engine=args.engine)
+                results['cases'].append(case)
+                print(f'{people_count:>9,} {mode:<12} {case["success_rate"]:>4.0%} ok  '
+                      f'{case["wall_median"]:8.3f}s  {case.get("peak_mb_max", 0):8.1f} MB', file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=1)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()
@@ -23,11 +23,37 @@ SOFTWARE. """
 
 import sys
 import argparse
-import json
-import numpy as np
-import traceback
-from random import sample
-from math import floor, ceil
+import importlib
+import os
+import random
+import re
+import time
+import heapq
+from array import array
+from copy import copy
+from itertools import accumulate, chain
+from math import floor, ceil, inf, isfinite
+
+
+# Modules that are slow to import are only imported the first time something uses them, so
+# --help and small rosters (which never touch numpy) start quickly. The first attribute
+# lookup imports the module and puts it in place of the stand-in
+class LazyModule:
+    def __init__(self, name, alias):
+        self._lazy_name = name
+        self._lazy_alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._lazy_name)
+        globals()[self._lazy_alias] = module
+        return getattr(module, attr)
+
+np = LazyModule('numpy', 'np')
+asyncio = LazyModule('asyncio', 'asyncio')
+hashlib = LazyModule('hashlib', 'hashlib')
+json = LazyModule('json', 'json')
+multiprocessing = LazyModule('multiprocessing', 'multiprocessing')
+traceback = LazyModule('traceback', 'traceback')
 
 
 def lp(msg):
@@ -42,19 +68,343 @@ def wrapped_teams_from_str(args, lines):
         traceback.print_exc()
         return {'error': f'unknown error'}
 
+# Batch mode runs many requests in one process. Each job is one json object per line with
+# the same fields as Args, plus the roster as a string ('roster') or a path ('file') and an
+# optional 'id' that is copied to its result. Results come back in job order, one dict per
+# job with an 'error' key for the ones that failed, and jobs can be spread over processes
+JOB_FIELDS = ('id', 'roster', 'file')
+# Options for how the command line prints teams, which jobs can't set since their results
+# are always sent on as json
+JOB_OUTPUT_FIELDS = ('json', 'separator')
+
+def run_batch(jobs, workers=1):
+    jobs = (job for job in jobs if job.strip())
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            yield from pool.map(run_job, jobs, chunksize=4)
+    else:
+        yield from map(run_job, jobs)
+
+def run_job(job_line):
+    try:
+        job = json.loads(job_line)
+    except ValueError as verr:
+        return {'error': f'Could not read job. {verr}'}
+    return job_result(job)
+
+def job_result(job):
+    try:
+        result = teams_from_job(job)
+    except ValueError as verr:
+        result = {'error': f'{verr}'}
+    except OSError as oerr:
+        result = {'error': f'Could not open or load "{job.get("file")}". {oerr.strerror}'}
+    except Exception as ex:
+        traceback.print_exc()
+        result = {'error': f'unknown error'}
+
+    if isinstance(job, dict) and 'id' in job:
+        result['id'] = job['id']
+    return result
+
+def teams_from_job(job):
+    if not isinstance(job, dict):
+        usage_error('Job must be a json object')
+
+    args = job_args(job)
+    if ('roster' in job) == ('file' in job):
+        usage_error("Job must have either a 'roster' or a 'file'")
+    for name in ('roster', 'file'):
+        if name in job and not isinstance(job[name], str):
+            usage_error(f"Job field '{name}' must be a string")
+
+    # results are sent on as json, so teams stay plain lists and are only encoded there
+    if 'roster' in job:
+        return team_result(args, iter_lines(job['roster']))
+    if args.compiled:
+        return team_result(args, compiled_roster(job['file']))
+    with open(job['file'], 'r') as people:
+        return team_result(args, people)
+
+# Fields with a None default and the type they take when set
+JOB_OPTIONAL_TYPES = {'seed': int, 'cache': str, 'deadline': (int, float), 'time_limit': (int, float)}
+
+# Args from the fields of a job. Values must have the type of the field's default (a number
+# for cache_size) and jobs are always quiet, progress messages would break the json lines
+def job_args(job):
+    args = default_args()
+    for name, value in job.items():
+        if name in JOB_FIELDS:
+            continue
+        if name in JOB_OUTPUT_FIELDS:
+            usage_error(f"Job field '{name}' is not allowed, job results are always json")
+        if not hasattr(args, name):
+            usage_error(f"Unknown job field '{name}'")
+
+        default = getattr(args, name)
+        if default is None:
+            expected = JOB_OPTIONAL_TYPES[name]
+            valid = value is None or isinstance(value, expected)
+        else:
+            expected = (int, float) if name == 'cache_size' else type(default)
+            valid = isinstance(value, expected)
+        # json true and false are ints to python, but not numbers here
+        if isinstance(value, bool) and not isinstance(default, bool):
+            valid = False
+        if not valid:
+            usage_error(f"Job field '{name}' has the wrong type, {json.dumps(value)}")
+        setattr(args, name, value)
+
+    args.verbose = 0
+    return args
+
+
+# Local http service. POST /teams takes one job object (as in batch mode, but only with an
+# inline 'roster' and the SERVICE_FIELDS) and answers with its result. Requests are read and
+# answered on the event loop while teams are made in a process pool. Once workers + queue
+# requests are running new ones get 503 rather than piling up. Each job carries its
+# deadline, so one that runs out of time gets 504 and its worker stops trying soon after.
+# GET /metrics reports counts and latency
+SERVICE_FIELDS = ('id', 'roster', 'timeout', 'oktogether', 'generations', 'teamsize', 'teamcount',
+                  'tries', 'uneven', 'drop', 'round', 'engine', 'seed', 'stats', 'rounds', 'balance', 'metadata',
+                  'time_limit', 'division_teams')
+
+class TeamService:
+    LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+    MAX_BODY = 64 * 1024 * 1024
+
+    def __init__(self, workers, queue, timeout):
+        self.workers = workers
+        self.capacity = workers + queue
+        self.timeout = timeout
+        self.loop = None
+        self.pool = None
+        self.in_flight = 0
+        self.statuses = {}
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = [0] * (len(self.LATENCY_BUCKETS) + 1)
+
+    async def serve(self, host, port, verbose=0):
+        server = await self.start(host, port)
+        try:
+            if verbose:
+                lp(f'Serving teams on http://{host}:{port}/teams with {self.workers} workers')
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.stop()
+
+    async def start(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        self.pool = self.new_pool()
+        return await asyncio.start_server(self.handle, host, port)
+
+    def new_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+        # forked workers would inherit the listening and client sockets and hold them open
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    # a worker that dies (killed, out of memory) breaks the whole pool, so later requests
+    # get a new one. Requests that noticed the same broken pool only replace it once
+    def replace_pool(self, pool):
+        if pool is self.pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = self.new_pool()
+
+    def stop(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    async def handle(self, reader, writer):
+        from http import HTTPStatus
+        start = time.perf_counter()
+        try:
+            status, body = await self.respond(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except ValueError as verr:
+            status, body = 400, {'error': f'{verr}'}
+
+        self.record(status, time.perf_counter() - start)
+        payload = json.dumps(body).encode('utf-8')
+        head = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}', 'Content-Type: application/json',
+                f'Content-Length: {len(payload)}', 'Connection: close']
+        if status == 503:
+            head.append('Retry-After: 1')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + payload)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def respond(self, reader):
+        request = (await reader.readline()).decode('latin-1').split()
+        if len(request) != 3:
+            usage_error('Malformed request line')
+        method, path, _ = request
+
+        length = 0
+        while True:
+            header = (await reader.readline()).decode('latin-1').strip()
+            if not header:
+                break
+            name, _, value = header.partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        if length < 0 or length > self.MAX_BODY:
+            usage_error('Bad request body size')
+        body = await reader.readexactly(length)
+
+        path = path.split('?')[0]
+        if path == '/metrics' and method == 'GET':
+            return 200, self.metrics()
+        if path != '/teams':
+            return 404, {'error': f'Unknown path {path}'}
+        if method != 'POST':
+            return 405, {'error': 'Use POST to create teams'}
+
+        try:
+            job = json.loads(body)
+        except ValueError as verr:
+            usage_error(f'Could not read job. {verr}')
+        if not isinstance(job, dict):
+            usage_error('Job must be a json object')
+        for name in job:
+            if name not in SERVICE_FIELDS:
+                usage_error(f"Job field '{name}' is not allowed by the service")
+
+        # a request can ask for a shorter deadline, but not a longer one
+        timeout = job.pop('timeout', self.timeout)
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            usage_error('Timeout must be a positive number of seconds')
+        timeout = min(timeout, self.timeout)
+
+        if self.in_flight >= self.capacity:
+            return 503, {'error': 'Too many requests in progress, try again later'}
+
+        job['deadline'] = time.time() + timeout
+        from concurrent.futures.process import BrokenProcessPool
+        pool = self.pool
+        try:
+            future = pool.submit(job_result, job)
+        except BrokenProcessPool:
+            self.replace_pool(pool)
+            return 500, {'error': 'Team workers stopped, try again'}
+        except Exception as ex:
+            return 500, {'error': f'Could not create teams. {ex}'}
+        # released by the future's callback however it finishes
+        self.in_flight += 1
+        future.add_done_callback(self.finished)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            return 504, {'error': f'Did not create teams within {timeout} seconds'}
+        except BrokenProcessPool:
+            self.replace_pool(pool)
+            return 500, {'error': 'Team workers stopped, try again'}
+        except Exception as ex:
+            return 500, {'error': f'Could not create teams. {ex}'}
+        return (400 if 'error' in result else 200), result
+
+    # called from the pool's thread, so hop back to the loop before touching counters
+    def finished(self, future):
+        self.loop.call_soon_threadsafe(self.release)
+
+    def release(self):
+        self.in_flight -= 1
+
+    def record(self, status, elapsed):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latency_count += 1
+        self.latency_sum += elapsed
+        self.latency_max = max(self.latency_max, elapsed)
+        for b_num, bound in enumerate(self.LATENCY_BUCKETS):
+            if elapsed <= bound:
+                break
+        else:
+            b_num = len(self.LATENCY_BUCKETS)
+        self.latency_buckets[b_num] += 1
+
+    def metrics(self):
+        buckets = {f'le_{bound}': count for bound, count in zip(self.LATENCY_BUCKETS, self.latency_buckets)}
+        buckets['le_inf'] = self.latency_buckets[-1]
+        return {'requests': self.latency_count, 'statuses': {str(k): v for k, v in sorted(self.statuses.items())},
+                'in_flight': self.in_flight, 'capacity': self.capacity,
+                'latency': {'mean': self.latency_sum / self.latency_count if self.latency_count else 0.0,
+                            'max': self.latency_max, 'buckets': buckets}}
+
+def serve(address, workers, queue, timeout, verbose=0):
+    host, _, port = address.rpartition(':')
+    asyncio.run(TeamService(workers, queue, timeout).serve(host or '127.0.0.1', int(port), verbose))
+
+
 def teams_from_str(args, lines):
-    return teams_from_list(args, lines.splitlines(keepends=False))
+    return teams_from_list(args, iter_lines(lines))
+
+# The result of team_result with its teams serialized by encoder, a function of the teams
+# and args (by default json with --json, otherwise text lines)
+def teams_from_list(args, lines, out=None, encoder=None):
+    result = team_result(args, lines, out)
+    if 'teams' in result:
+        result['teams'] = (encoder or ENCODERS['json' if args.json else 'text'])(result['teams'], args)
+    return result
 
-def teams_from_list(args, lines):
+def encode_json(teams, args):
+    return json.dumps(teams)
+
+# one team per line, with a blank line between rounds, and divisions each under their
+# own tag line
+def encode_text(teams, args):
+    if isinstance(teams, dict):
+        return '\n\n'.join(f'[{division}]\n' + encode_text(d_teams, args) for division, d_teams in teams.items())
+    rounds = teams if args.rounds > 1 else [teams]
+    return '\n\n'.join('\n'.join(args.separator.join(t) for t in r_teams) for r_teams in rounds)
+
+ENCODERS = {'json': encode_json, 'text': encode_text}
+
+# Makes the teams and returns the counts and the teams as plain python data: a list of
+# teams, each a list of names sorted by category (a list of those per round with rounds).
+# With metadata, 'families' and 'categories' give each person's family (one per roster
+# line) and category in the same shape. Nothing is serialized, that is left to whoever
+# sends the result on. With out (anything with a write method) each team is written there
+# as soon as it is formatted, as text lines or with json as one json list per line, and
+# the result has no 'teams'. Streamed requests skip the cache, which stores whole results
+def team_result(args, lines, out=None):
+    # a roster split into divisions is teamed one division at a time
+    if not isinstance(lines, Roster):
+        lines, shards = split_divisions(lines)
+        if shards is not None:
+            return division_result(args, shards, out)
 
     normalize_args(args)
+    if args.division_teams:
+        usage_error('Teams for divisions were given, but the roster has no divisions')
     assert args.teamsize >= 0
     assert args.teamcount >= 0
+    deadline_check(args)
+    # the time limit counts from here, and tries=0 then leaves it as the only budget
+    best = BestTry(time.time() + args.time_limit) if args.time_limit is not None else None
+    tries = inf if best is not None and args.tries == 0 else args.tries
+
+    stats = Stats() if args.stats else NO_STATS
 
     if args.verbose:
         dump_plan(args)
         lp(f'\n~~~~ Distributing ~~~~')
 
+    # only seeded single worker requests are repeatable, so only those are cached (not ones
+    # with a time limit, where the teams depend on how far the search got). Lines are
+    # hashed as the parser reads them, so the key is known once parsing is done
+    cache = key = None
+    if args.cache and args.seed is not None and out is None and best is None:
+        cache = ResultCache(args.cache, args.cache_size)
+        if not isinstance(lines, Roster):
+            lines = cache.hash_lines(lines)
+
     if args.round == 'closest':
         rounder = round
     elif args.round == 'down':
@@ -62,41 +412,34 @@ def teams_from_list(args, lines):
     else:
         rounder = ceil
 
-    family_sizes = []
-    categories = []
-    try:
-        for i, family in enumerate(lines):
-            if not isinstance(family, str):
-                raise ValueError('Contains unreadable characters')
-            family = family.strip()
-            if len(family) < 1 or family[0] == '#':
-                continue
-
-            fam_size = 0
-            cat_strings = family.split(':')
-            for cat_num, cat_string in enumerate(cat_strings):
-                # must add the category even if emppty on this line to ensure
-                # categories that follow go into the correct offset
-                if len(categories) <= cat_num:
-                    categories.append([])
-                cat_string = cat_string.strip()
-                if cat_string:
-                    # iter(lambda:i, -1) is an iterator that returns i forever when i >= 0
-                    tuples = list(zip([s.strip() for s in cat_string.split(',') if s.strip()], iter(lambda:i, -1), iter(lambda:cat_num, -1) ))
-                    categories[cat_num].extend(tuples)
-                    fam_size += len(tuples)
-
-
-            family_sizes.append(fam_size)
-        #filter out empty categories (None returns False for empty arrays)
-        categories = list(filter(None, categories))
-
-    except ValueError as verr:
-        usage_error(f'Could not read family data. {verr}')
-    except Exception as ex:
-        usage_error(f'Could not read family data.')
-
-    remaining_count = people_count = sum(family_sizes)
+    # lines can also be an already parsed (or compiled) roster
+    roster = lines if isinstance(lines, Roster) else read_roster(lines)
+    stats.lap('parse')
+    if cache is not None:
+        key = cache.key(args, roster)
+        result = cache.get(key)
+        stats.lap('cache')
+        if result is not None:
+            if args.verbose:
+                lp(f'Using cached result')
+            if args.stats:
+                result['stats'] = dict(stats.as_dict(), cached=True)
+            return result
+
+    remaining_count = people_count = len(roster)
+
+    # small rosters are teamed in plain python, which is quicker than importing numpy
+    small = (isinstance(roster, RosterBuffers) and people_count <= SMALL_ROSTER and args.workers == 1
+             and args.rounds == 1 and not args.balance and (args.oktogether or args.engine == 'constructive'))
+    if not small and isinstance(roster, RosterBuffers):
+        roster = roster.columns()
+        stats.lap('parse')
+
+    if args.balance and roster.rating is None:
+        usage_error("Balancing teams needs ratings, add one after a person's name like 'Ava Peters = 4.5'")
+
+    family_sizes = roster.family_sizes
+    categories = roster.categories()
     category_count = len(categories)
 
     if args.verbose:
@@ -140,99 +483,1375 @@ def teams_from_list(args, lines):
     if team_count == 1:
         usage_error('Inputs would result in only 1 team')
 
-    # Determine if lagest families make it impossible to avoid overalap. We should use this to
-    # stear drops below to larger families rather than just be random. Could also use this to
-    # increase drop_count or team_count and restart
+    # Determine if lagest families make it impossible to avoid overalap. Drops below come out
+    # of those families first
     if not args.oktogether:
         # filter to families larger than team_count, then subtract team_count from each to find extras
-        extras = [fsz - team_count for fsz in filter(lambda sz: sz > team_count, family_sizes)]
-        if (sum(extras) - drop_count) > 0:
+        if small:
+            extras = sum(fsz - team_count for fsz in family_sizes if fsz > team_count)
+        else:
+            extras = int((family_sizes[family_sizes > team_count] - team_count).sum())
+        if (extras - drop_count) > 0:
             usage_error(f"Inputs result in {team_count} teams, which is not enough to distribute the largest group of {max(family_sizes)} people. Consider using the 'oktogether' option")
 
 
-    # Needed because during drop categories can be empty, and the dimensions get lost
-    for cat_num, cat in enumerate(categories):
-        categories[cat_num] = np.array(cat).reshape((-1, 3))
+    stats.lap('plan')
+    rng = random.Random(args.seed) if small else np.random.default_rng(args.seed)
+    if drop_count > 0:
+        if args.verbose:
+            lp(f'dropping {drop_count} {"people" if drop_count > 1 else "person"}')
+        roster, categories = drop_people(roster, categories, team_count, drop_count, args, rng, small)
+        if args.verbose:
+            lp(f'{sum(len(cat) for cat in categories)} people remaining, {[len(cat) for cat in categories]} people per category')
+        stats.lap('drop')
+    elif not args.oktogether:
+        problem = feasibility_problem(roster, categories, team_count, args.generations, small)
+        if problem is not None:
+            usage_error(f"No valid teams exist: {problem}. Consider using the 'oktogether' option")
+        stats.lap('feasible')
+
+    repairs = 0
+    spread = None
+    if args.balance:
+        teams, count, repairs, spread = balanced_search(args, roster, categories, team_count, rng, stats)
+    elif args.rounds > 1:
+        rounds, count, repairs, repeats = tournament(args, roster, categories, team_count, rng, stats)
+        teams = rounds[-1] if rounds else None
+    elif small:
+        teams, count = small_search(args, roster, categories, team_count, tries, rng, stats, best)
+    elif args.workers > 1:
+        teams, count, repairs = parallel_search(args, roster, categories, team_count, stats)
+    else:
+        teams, count, repairs = search_teams(args, roster, categories, team_count, tries, rng, stats, best=best)
+    # whatever the search phases above did not claim, all of it for a pool of workers
+    stats.lap('search')
+
+    # with a time limit the best try stands in for valid teams, conflicts and all
+    conflicts = None
+    if teams is None and best is not None and best.teams is not None:
+        deadline_check(args)
+        if args.verbose:
+            lp(f'Out of {"time" if best.expired() else "tries"} after {count:,} tries, using the one with the fewest conflicts ({best.conflicts})')
+        teams = best.teams
+        conflicts = team_conflicts(roster, teams, small)
+        count -= 1
+
+    if teams is None:
+        deadline_check(args)
+        usage_error(f"Did not create valid teams in {count:,} attempts{f' for round {len(rounds) + 1}' if args.rounds > 1 else ''}. Consider using the 'oktogether'' or 'tries' options")
+
+    remaining_count = sum(len(t) for t in teams)
+    if args.rounds == 1:
+        rounds = [teams]
+    else:
+        # count is every try of every round, make it the failed ones plus the last success
+        count -= 1
 
-    # make copies for redropping (below)
-    categories_orig = categories.copy()
+    if args.verbose:
+        lp(f'\n~~~~ Results: {team_count} team{"s" if team_count > 1 else ""}, {remaining_count} people{" (" +str(drop_count)+ " dropped)" if args.drop else ""}, {category_count} {"category" if category_count ==1 else "categories"}. Took {count+1} {"try" if count ==0 else "tries"}{f" and {repairs} repair swaps" if repairs else ""}~~~~')
+        if args.rounds > 1:
+            lp(f'{args.rounds} rounds with {repeats} repeat pairs of teammates')
+        if spread is not None:
+            lp(f'team rating totals are within {spread:g} of each other')
+
+    if out is None:
+        rounds = [sorted_teams(roster, teams, small) for teams in rounds]
+    else:
+        sink = JsonLinesSink(out, args.rounds > 1) if args.json else TextSink(out, args.separator)
+        for r_num, teams in enumerate(rounds):
+            for t in teams:
+                sink.team(roster.team_names(sorted_rows(roster, t, small)), r_num)
 
-    # can end up dropping people that make it impossible to create valid teams, so retry
-    # the drop every 10% of the retry count
-    drop_step = min(ceil(args.tries / 10), 100)
-    retry = True
-    count = 0
-    teams = []
-    rng = np.random.default_rng()
+    result = { 'team_count' : team_count, 'player_count': remaining_count,
+              'category_count': category_count, 'drop_count': drop_count, 'tries': count+1,
+              'repairs': repairs }
+    if args.rounds > 1:
+        result['rounds'] = args.rounds
+        result['repeats'] = repeats
+    if spread is not None:
+        result['spread'] = spread
+    if conflicts is not None:
+        result['partial'] = True
+        result['conflicts'] = conflicts
+    if out is None:
+        columns = {'teams': roster.team_names}
+        if args.metadata:
+            columns['families'] = lambda rows: column_values(roster.family, rows, small)
+            columns['categories'] = lambda rows: column_values(roster.category, rows, small)
+        for name, column in columns.items():
+            values = [per_team(column, teams) for teams in rounds]
+            result[name] = values if args.rounds > 1 else values[0]
+
+    if cache is not None:
+        cache.put(key, result)
+
+    stats.lap('output')
+    if args.stats:
+        result['stats'] = stats.as_dict()
+    return result
 
-    categories_copy = categories_orig.copy()
 
-    # need to make this better than brute force someday
-    while retry:
-        if drop_count > 0 and count % drop_step == 0:
-            categories_copy = do_drop(categories_orig, drop_count, args.verbose)
-            remaining_count = sum([len(cat) for cat in categories_copy])
+# A roster line can start with its division, like "[Under 10] Ava, Ben : Cal". Once the
+# first line has one every line needs one. Returns the lines (read up to the first person)
+# when there are no divisions, otherwise None and each division's lines without the tag
+def split_divisions(lines):
+    lines = iter(lines)
+    head = []
+    for line in lines:
+        head.append(line)
+        if not isinstance(line, str) or (line.strip() and line.strip()[0] != '#'):
+            break
+    if not head or not isinstance(head[-1], str) or not head[-1].strip().startswith('['):
+        return chain(head, lines), None
+
+    shards = {}
+    for line in chain(head, lines):
+        if not isinstance(line, str):
+            usage_error('Could not read family data. Contains unreadable characters')
+        line = line.strip()
+        if len(line) < 1 or line[0] == '#':
+            continue
+        division, tagged, people = line[1:].partition(']') if line[0] == '[' else ('', '', '')
+        if not tagged or not division.strip():
+            usage_error(f'Could not read family data. Every line needs a division once the first has one, like "[Under 10] Ava, Ben : Cal"')
+        shards.setdefault(division.strip(), []).append(people)
+    return None, shards
+
+# Teams each division as its own request, with the team size or count division_teams gives
+# it (or the request's), spread over workers processes. Results are merged into one, with
+# counts added up, the teams (and metadata and stats) keyed by division, and each
+# division's own counts under 'divisions'
+def division_result(args, shards, out):
+    if out is not None:
+        usage_error('Cannot stream teams for a roster with divisions')
+    for name, teams in args.division_teams.items():
+        if name not in shards:
+            usage_error(f'No division named {name} in the roster')
+        if not isinstance(teams, dict) or len(teams) != 1 or not isinstance(next(iter(teams.values())), int) \
+                or next(iter(teams)) not in ('teamsize', 'teamcount'):
+            usage_error(f"Teams for division {name} must be given as either teamsize or teamcount, like {{'teamsize': 4}}")
+
+    # shards get their own copy of the args before these are normalized
+    shard_args = {}
+    for name in shards:
+        shard_args[name] = copy(args)
+        shard_args[name].division_teams = {}
+        shard_args[name].workers = 1
+        if name in args.division_teams:
+            shard_args[name].teamsize = shard_args[name].teamcount = -999
+            for field, value in args.division_teams[name].items():
+                setattr(shard_args[name], field, value)
+    # each division runs in one process, the workers only spread divisions, so the checks
+    # against more than 1 worker (rounds, time limit, cache) don't apply here
+    workers = args.workers
+    args.workers = min(workers, 1)
+    normalize_args(args)
+    args.workers = workers
+
+    workers = min(args.workers, len(shards))
+    results = {}
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for name in shards:
+                shard_args[name].verbose = 0
+            futures = {name: pool.submit(team_result, shard_args[name], lines) for name, lines in shards.items()}
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except ValueError as verr:
+                    usage_error(f'Division {name}: {verr}')
+    else:
+        for name, lines in shards.items():
+            if args.verbose:
+                lp(f'\n~~~~ Division {name} ~~~~')
+            try:
+                results[name] = team_result(shard_args[name], lines)
+            except ValueError as verr:
+                usage_error(f'Division {name}: {verr}')
+
+    result = {'team_count': 0, 'player_count': 0, 'category_count': 0, 'drop_count': 0, 'tries': 0, 'repairs': 0}
+    for shard in results.values():
+        for name in result:
+            result[name] = max(result[name], shard[name]) if name == 'category_count' else result[name] + shard[name]
+    keyed = ('teams', 'families', 'categories', 'stats')
+    for name in keyed:
+        if any(name in shard for shard in results.values()):
+            result[name] = {division: shard[name] for division, shard in results.items()}
+    if any(shard.get('partial') for shard in results.values()):
+        result['partial'] = True
+        result['conflicts'] = [names for shard in results.values() for names in shard.get('conflicts', [])]
+    result['divisions'] = {division: {name: value for name, value in shard.items() if name not in keyed}
+                           for division, shard in results.items()}
+    return result
 
-        categories = categories_copy.copy()
+# column (a function of rows) for each team of sorted_teams, looked up for all the rows in
+# one call rather than one small call per team
+def per_team(column, team_rows):
+    rows, ends = team_rows
+    values = column(rows)
+    return [values[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+# Plain ints from a roster column for a team's rows
+def column_values(column, rows, small):
+    if small:
+        return [int(column[row]) for row in rows]
+    return column[rows].tolist()
+
+# A team's rows sorted by their people's original category
+def sorted_rows(roster, team, small):
+    if small:
+        return sorted(team, key=roster.category.__getitem__)
+    return team[np.argsort(roster.category[team], kind='stable')]
+
+# Every team's rows sorted as sorted_rows does, one team after another, and where each
+# team ends. Large rosters sort all of them at once
+def sorted_teams(roster, teams, small):
+    sizes = [len(t) for t in teams]
+    ends = list(accumulate(sizes))
+    if small:
+        return [row for t in teams for row in sorted_rows(roster, t, small)], ends
+    rows = np.concatenate(teams)
+    team_ids = np.repeat(np.arange(len(teams)), sizes)
+    return rows[np.lexsort((roster.category[rows], team_ids))], ends
+
+# Writes teams one line each as they are formatted, with a blank line between rounds
+class TextSink:
+    def __init__(self, out, separator):
+        self.out = out
+        self.separator = separator
+        self.round = 0
+
+    def team(self, names, round_num):
+        if round_num != self.round:
+            self.out.write('\n')
+            self.round = round_num
+        self.out.write(self.separator.join(names) + '\n')
+
+# Writes each team as a json list on its own line, or with rounds as an object with the
+# round (from 1) and the team
+class JsonLinesSink:
+    def __init__(self, out, rounds):
+        self.out = out
+        self.rounds = rounds
+
+    def team(self, names, round_num):
+        line = {'round': round_num + 1, 'team': names} if self.rounds else names
+        self.out.write(json.dumps(line) + '\n')
+
+
+# Re-teaming after people arrive late or leave. previous is a result made with metadata
+# (teams with their families and categories), lines are roster lines of the people to
+# add and removed the names of the people to take out. Names identify people, so a line
+# that includes someone already on a team adds its other people to that person's family.
+# Only the teams that lose or gain people change: each newcomer joins the smallest team
+# without their family, and then people move from the largest teams to the smallest until
+# sizes are within one of each other. Returns a result like team_result's with the
+# metadata, plus how many people were added, removed and moved to another team
+def reteam(args, previous, lines=(), removed=()):
+    normalize_args(args)
+    if not isinstance(previous, dict) or any(key not in previous for key in ('teams', 'families', 'categories')):
+        usage_error("Re-teaming needs a previous result with its 'families' and 'categories', made with the metadata option")
+
+    buffers = read_roster(lines)
+    rows = {}
+    for row, fam in enumerate(buffers.family):
+        rows.setdefault(fam, []).append(row)
+    names = buffers.team_names(range(len(buffers)))
+    edit = TeamEdit(previous['teams'], previous['families'], previous['categories'], set(removed) | set(names),
+                    args.oktogether)
+
+    for name in removed:
+        edit.remove(name)
+
+    added = 0
+    for fam_rows in rows.values():
+        known = [names[row] for row in fam_rows if names[row] in edit.where]
+        fam = edit.family_of(known[0]) if known else edit.new_family()
+        for row in fam_rows:
+            if names[row] not in edit.where:
+                edit.add(names[row], fam, buffers.category[row])
+                added += 1
+
+    edit.even_out()
+    moved = edit.moved()
+    if args.verbose:
+        lp(f'Added {added}, removed {len(removed)} and moved {moved} {"person" if moved == 1 else "people"} on {len(edit.teams)} teams')
+
+    teams, families, categories = edit.sorted()
+    return {'team_count': len(teams), 'player_count': previous.get('player_count', 0) + added - len(removed),
+            'category_count': max(previous.get('category_count', 0), max(buffers.category, default=-1) + 1),
+            'added': added, 'removed': len(removed), 'moved': moved,
+            'teams': teams, 'families': families, 'categories': categories}
+
+# The teams of a previous result being edited, which stay as they are (shared with the
+# previous result) until something changes them. Only the names in wanted are looked up
+# and only touched teams get their family counts worked out, so an edit costs about one
+# pass over the names plus the work for the people who change. The smallest and largest
+# teams come from heaps whose stale entries (a team that has changed size since) are
+# skipped
+class TeamEdit:
+    def __init__(self, teams, families, categories, wanted, oktogether):
+        if (not isinstance(teams, list) or not isinstance(families, list) or not isinstance(categories, list)
+                or len(teams) != len(families) or len(teams) != len(categories)):
+            usage_error('Previous result must be one round of teams with matching families and categories')
+        if len(teams) < 2:
+            usage_error('Previous result must have at least 2 teams')
+
+        self.teams = list(teams)
+        self.families = list(families)
+        self.categories = list(categories)
+        self.oktogether = oktogether
+        self.where = {}
+        for t_num, team in enumerate(self.teams):
+            if not wanted.isdisjoint(team):
+                self.where.update((name, t_num) for name in team if name in wanted)
+        self.next_family = max(map(max, filter(None, self.families)), default=-1) + 1
+        self.counts = {}
+        self.touched = set()
+        self.new = set()
+        self.first_team = {}
+        sizes = list(map(len, self.teams))
+        self.smallest = list(zip(sizes, range(len(sizes))))
+        self.largest = list(zip([-size for size in sizes], range(len(sizes))))
+        heapq.heapify(self.smallest)
+        heapq.heapify(self.largest)
+
+    # copies a team's lists the first time it changes
+    def touch(self, t_num):
+        if t_num not in self.touched:
+            team, fams, cats = self.teams[t_num], self.families[t_num], self.categories[t_num]
+            if not isinstance(team, list) or len(team) != len(fams) or len(team) != len(cats):
+                usage_error(f'Previous team {t_num + 1} does not match its families and categories')
+            self.teams[t_num], self.families[t_num], self.categories[t_num] = list(team), list(fams), list(cats)
+            self.touched.add(t_num)
+
+    def family_of(self, name):
+        t_num = self.where[name]
+        self.touch(t_num)
+        return self.families[t_num][self.teams[t_num].index(name)]
+
+    def new_family(self):
+        self.next_family += 1
+        return self.next_family - 1
+
+    # how many of each family a team has
+    def team_counts(self, t_num):
+        if t_num not in self.counts:
+            self.touch(t_num)
+            counts = {}
+            for fam in self.families[t_num]:
+                counts[fam] = counts.get(fam, 0) + 1
+            self.counts[t_num] = counts
+        return self.counts[t_num]
+
+    def resized(self, t_num):
+        size = len(self.teams[t_num])
+        heapq.heappush(self.smallest, (size, t_num))
+        heapq.heappush(self.largest, (-size, t_num))
+
+    def remove(self, name):
+        if name not in self.where:
+            usage_error(f'Cannot remove {name}, who is not on any team')
+        t_num = self.where.pop(name)
+        counts = self.team_counts(t_num)
+        p_num = self.teams[t_num].index(name)
+        counts[self.families[t_num][p_num]] -= 1
+        for column in (self.teams, self.families, self.categories):
+            column[t_num].pop(p_num)
+        self.resized(t_num)
+
+    def place(self, name, fam, cat, t_num):
+        counts = self.team_counts(t_num)
+        counts[fam] = counts.get(fam, 0) + 1
+        self.teams[t_num].append(name)
+        self.families[t_num].append(fam)
+        self.categories[t_num].append(cat)
+        self.where[name] = t_num
+        self.resized(t_num)
+
+    def fits(self, fam, t_num):
+        return self.oktogether or self.team_counts(t_num).get(fam, 0) == 0
+
+    # the current smallest (or largest) team, popping entries that are out of date. None
+    # once every team has been popped
+    def peek(self, heap, sign):
+        while heap and sign * heap[0][0] != len(self.teams[heap[0][1]]):
+            heapq.heappop(heap)
+        return heap[0][1] if heap else None
+
+    # a newcomer joins the smallest team that has none of their family
+    def add(self, name, fam, cat):
+        skipped = []
+        t_num = self.peek(self.smallest, 1)
+        while t_num is not None and not self.fits(fam, t_num):
+            skipped.append(heapq.heappop(self.smallest))
+            t_num = self.peek(self.smallest, 1)
+        for entry in skipped:
+            heapq.heappush(self.smallest, entry)
+        if t_num is None:
+            usage_error(f'Cannot add {name}, every team already has someone from their family')
+        self.new.add(name)
+        self.place(name, fam, cat, t_num)
+
+    # Moves people from the largest teams to the smallest until sizes are within one. The
+    # person moved is one whose family is not on the small team, from the category the
+    # small team has fewest of
+    def even_out(self):
+        while True:
+            small = self.peek(self.smallest, 1)
+            big = self.peek(self.largest, -1)
+            if len(self.teams[big]) - len(self.teams[small]) <= 1:
+                return
+
+            have = {}
+            for cat in self.categories[small]:
+                have[cat] = have.get(cat, 0) + 1
+            # any team at least two larger than the small one can give someone up
+            skipped = []
+            pick = None
+            while big is not None and len(self.teams[big]) - len(self.teams[small]) > 1:
+                self.touch(big)
+                movable = [p_num for p_num, fam in enumerate(self.families[big]) if self.fits(fam, small)]
+                if movable:
+                    pick = min(movable, key=lambda p_num: have.get(self.categories[big][p_num], 0))
+                    break
+                skipped.append(heapq.heappop(self.largest))
+                big = self.peek(self.largest, -1)
+            for entry in skipped:
+                heapq.heappush(self.largest, entry)
+            if pick is None:
+                usage_error('Cannot even out team sizes without family members sharing a team')
+
+            name = self.teams[big][pick]
+            fam, cat = self.families[big][pick], self.categories[big][pick]
+            self.where[name] = big
+            self.first_team.setdefault(name, big)
+            self.remove(name)
+            self.place(name, fam, cat, small)
+
+    # people from the previous teams who ended up on another team
+    def moved(self):
+        return sum(1 for name, t_num in self.first_team.items() if name not in self.new and self.where[name] != t_num)
+
+    # the teams, families and categories with each touched team sorted by category again
+    def sorted(self):
+        for t_num in self.touched:
+            order = sorted(range(len(self.teams[t_num])), key=self.categories[t_num].__getitem__)
+            for column in (self.teams, self.families, self.categories):
+                column[t_num] = [column[t_num][p_num] for p_num in order]
+        return self.teams, self.families, self.categories
+
+# On-disk cache of results keyed by a hash of the normalized roster, the arguments that
+# change the result and the seed. Each result is one small json file and the least recently
+# used ones are removed once the directory grows past max_mb
+class ResultCache:
+    # arguments that can change the result (not verbose, workers or the cache settings)
+    KEY_ARGS = ('oktogether', 'generations', 'teamsize', 'teamcount', 'tries', 'uneven', 'drop',
+                'round', 'engine', 'seed', 'rounds', 'balance', 'metadata')
+
+    def __init__(self, path, max_mb):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.roster_sha = None
+        os.makedirs(path, exist_ok=True)
+
+    # Passes the lines on unchanged while hashing the roster they hold, ignoring comments and
+    # spacing. Unreadable lines are passed on too, parsing will report them
+    def hash_lines(self, lines):
+        self.roster_sha = hashlib.sha256()
+        for line in lines:
+            if isinstance(line, str):
+                normal = line.strip()
+                if len(normal) > 0 and normal[0] != '#':
+                    cats = [[p.strip() for p in cat.split(',') if p.strip()] for cat in normal.split(':')]
+                    self.roster_sha.update(json.dumps(cats).encode() + b'\n')
+            yield line
+
+    # rosters that were not read through hash_lines (already parsed or compiled) are keyed
+    # on their columns instead
+    def key(self, args, roster):
+        if self.roster_sha is not None:
+            return self.hash(self.roster_sha.hexdigest(), args)
+        return self.hash(roster.digest(), args)
+
+    def hash(self, roster, args):
+        normal = {'roster': roster, 'args': {name: getattr(args, name) for name in self.KEY_ARGS}}
+        return hashlib.sha256(json.dumps(normal).encode()).hexdigest()
+
+    def get(self, key):
+        if key is None:
+            return None
+        file_name = os.path.join(self.path, key + '.json')
+        try:
+            with open(file_name, 'r') as cached:
+                result = json.load(cached)
+            # mtime is the last use for LRU eviction
+            os.utime(file_name)
+            return result
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, result):
+        if key is None:
+            return
+        file_name = os.path.join(self.path, key + '.json')
+        temp_name = f'{file_name}.{os.getpid()}.tmp'
+        with open(temp_name, 'w') as cached:
+            json.dump(result, cached)
+        os.replace(temp_name, file_name)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.path) as scan:
+            for entry in scan:
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        entries.sort()
+        for _, size, file_name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+            total -= size
+
+# Columnar roster with one row per person. Engines only move row numbers around and look
+# at the integer family and category columns. Names live in one side table and are only
+# looked up when output is formatted. rating is None unless the roster rated someone, and
+# is nan for anyone it did not rate
+class Roster:
+    def __init__(self, names, name, family, category, family_sizes, rating=None):
+        self.names = names
+        self.name = name
+        self.family = family
+        self.category = category
+        self.family_sizes = family_sizes
+        self.rating = rating
+        self.category_count = int(category.max()) + 1 if len(category) else 0
+
+    def __len__(self):
+        return len(self.family)
+
+    # row numbers of the people in each category
+    def categories(self):
+        if self.category_count == 0:
+            return []
+        order = np.argsort(self.category, kind='stable').astype(np.int32)
+        bounds = np.cumsum(np.bincount(self.category, minlength=self.category_count))[:-1]
+        return np.split(order, bounds)
+
+    def team_names(self, team):
+        return self.names.lookup(self.name[team])
+
+    # the roster with only the given rows, which keep their names and families
+    def take(self, rows):
+        family = self.family[rows]
+        return Roster(self.names, self.name[rows], family, self.category[rows],
+                      np.bincount(family, minlength=len(self.family_sizes)).astype(np.int32),
+                      None if self.rating is None else self.rating[rows])
+
+    # hash of the columns and names, used to key the result cache when there are no lines
+    def digest(self):
+        sha = hashlib.sha256()
+        sha.update(np.ascontiguousarray(self.family).tobytes())
+        sha.update(np.ascontiguousarray(self.category).tobytes())
+        if self.rating is not None:
+            sha.update(np.ascontiguousarray(self.rating).tobytes())
+        # names by their bytes, so hashing never decodes them
+        sha.update(np.ascontiguousarray(self.name).tobytes())
+        sha.update(np.ascontiguousarray(self.names.offsets).tobytes())
+        sha.update(memoryview(self.names.blob))
+        return sha.hexdigest()
+
+
+# Names packed as one utf-8 blob plus the offset of where each name starts, rather than a
+# python str per person, which also lets compiled rosters memory-map them. Names are only
+# decoded when looked up
+class NameTable:
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        return bytes(self.blob[self.offsets[n]:self.offsets[n+1]]).decode('utf-8')
+
+    # Names of many indices at once. Offsets are gathered in one go when they are numpy and
+    # each name is decoded straight from a view of the blob, without a copy of its bytes
+    def lookup(self, indices):
+        if isinstance(self.offsets, array):
+            starts = [self.offsets[n] for n in indices]
+            ends = [self.offsets[n + 1] for n in indices]
+        else:
+            indices = np.asarray(indices, dtype=np.int64)
+            starts, ends = self.offsets[indices].tolist(), self.offsets[indices + 1].tolist()
+        blob = memoryview(self.blob)
+        return [str(blob[start:end], 'utf-8') for start, end in zip(starts, ends)]
+
+
+# The roster as read, before it becomes numpy columns. Small rosters are teamed straight
+# from these buffers, the rest are turned into a Roster by columns()
+class RosterBuffers:
+    def __init__(self, names, family, category, family_sizes, rating=None):
+        self.names = names
+        self.family = family
+        self.category = category
+        self.family_sizes = family_sizes
+        self.rating = rating
+
+    def __len__(self):
+        return len(self.family)
+
+    # row numbers of the people in each category, leaving out categories no one is in
+    def categories(self):
+        cats = {}
+        for row, cat in enumerate(self.category):
+            cats.setdefault(cat, []).append(row)
+        return [cats[cat] for cat in sorted(cats)]
+
+    def team_names(self, team):
+        return self.names.lookup(team)
+
+    def columns(self):
+        # renumber categories so ones that are empty on every line are dropped
+        category = np.frombuffer(self.category, dtype=np.int16)
+        used = np.bincount(category) > 0 if len(category) else np.zeros(0, dtype=bool)
+        category = (np.cumsum(used) - 1).astype(np.int16)[category]
+
+        names = NameTable(np.frombuffer(self.names.offsets, dtype=np.int64), np.frombuffer(self.names.blob, dtype=np.uint8))
+        return Roster(names, np.arange(len(self), dtype=np.int32), np.frombuffer(self.family, dtype=np.int32),
+                      category, np.frombuffer(self.family_sizes, dtype=np.int32),
+                      None if self.rating is None else np.frombuffer(self.rating, dtype=np.float64))
+
+
+def parse_roster(lines):
+    return read_roster(lines).columns()
+
+# Reads any iterable of lines (a list, an open file or stdin) one line at a time, so the
+# whole input is never held as a list of strings. People go straight into typed buffers
+# that grow in place (names as one utf-8 blob) and become the numpy columns without a copy.
+# A person can have a rating after an equals sign ("Ava Peters = 4.5"), the rating column
+# only exists once someone has one
+def read_roster(lines):
+    name_blob = bytearray()
+    name_offsets = array('q', [0])
+    family = array('i')
+    category = array('h')
+    family_sizes = array('i')
+    rating = None
+    try:
+        for line in lines:
+            if not isinstance(line, str):
+                raise ValueError('Contains unreadable characters')
+            line = line.strip()
+            if len(line) < 1 or line[0] == '#':
+                continue
+            if line[0] == '[':
+                raise ValueError('Only rosters whose first line has a division can give divisions')
 
-        for cat in categories:
-            rng.shuffle(cat)
+            fam_num = len(family_sizes)
+            fam_size = 0
+            for cat_num, cat_string in enumerate(line.split(':')):
+                for person in cat_string.split(','):
+                    person = person.strip()
+                    if person:
+                        person, rated, rating_text = person.partition('=')
+                        if rated:
+                            person = person.strip()
+                            if not person:
+                                raise ValueError(f'Rating {rating_text.strip()} has no name')
+                            try:
+                                person_rating = float(rating_text)
+                            except ValueError:
+                                person_rating = None
+                            if person_rating is None or not isfinite(person_rating):
+                                raise ValueError(f'Rating of {person} is not a number')
+                            if rating is None:
+                                rating = array('d', [float('nan')]) * len(family)
+                        if rating is not None:
+                            rating.append(person_rating if rated else float('nan'))
+                        name_blob += person.encode('utf-8')
+                        name_offsets.append(len(name_blob))
+                        family.append(fam_num)
+                        category.append(cat_num)
+                        fam_size += 1
 
-        teams = []
-        if args.generations:
-            merged = np.concatenate(categories)
-            teams = np.array_split(merged, team_count)
-        else:
-            balance_categories(categories, team_count)
+            family_sizes.append(fam_size)
 
-            for cat in categories:
-                tsplit = np.array_split(cat, team_count)
-                for t in range(team_count):
-                    if len(teams) <= t:
-                        teams.append(tsplit[t])
-                    else:
-                        teams[t] = np.concatenate((teams[t], tsplit[t]))
+    except UnicodeDecodeError:
+        # reading a file that is not text, let the caller say which file
+        raise
+    except ValueError as verr:
+        usage_error(f'Could not read family data. {verr}')
+    except Exception as ex:
+        usage_error(f'Could not read family data.')
 
-        retry = False
-        if not args.oktogether: 
-            for t in teams:
-                fams = np.take(t, 1, 1)
-                if len(np.unique(fams, return_counts=True)[1]) != len(t):                
-                    count += 1
-                    retry = True
-                    if args.verbose > 1:
-                        lp(f'try {count:,} failed due to conflict {list(np.take(t, 0, 1))}')
-                    break
+    return RosterBuffers(NameTable(name_offsets, name_blob), family, category, family_sizes, rating)
+
+
+# The line boundaries str.splitlines() uses
+LINE_BREAK = re.compile('\r\n|[\r\n\v\f\x1c-\x1e\x85\u2028\u2029]')
+
+# Yields the lines of a string without splitting it into a list first, breaking
+# them where str.splitlines() would
+def iter_lines(text):
+    if not isinstance(text, str):
+        # not text, parsing will reject it
+        yield from text
+        return
+
+    start = 0
+    for line_break in LINE_BREAK.finditer(text):
+        yield text[start:line_break.start()]
+        start = line_break.end()
+    if start < len(text):
+        yield text[start:]
+
+
+# A compiled roster is a directory next to the text file (people.txt.hyc) holding one .npy
+# file per column plus the packed names. source.json records the size, mtime and hash of
+# the text it came from, so an edited text file is recompiled on next use. Columns are
+# memory-mapped rather than read, so repeat runs on large rosters skip parsing entirely.
+# Rosters with ratings also get rating.npy
+COMPILED_COLUMNS = ('family', 'category', 'family_sizes', 'name_offsets', 'name_blob')
+
+def compiled_path(file_name):
+    return file_name + '.hyc'
+
+def source_stamp(file_name, with_hash):
+    stat = os.stat(file_name)
+    stamp = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        sha = hashlib.sha256()
+        with open(file_name, 'rb') as source:
+            for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                sha.update(chunk)
+        stamp['sha256'] = sha.hexdigest()
+    return stamp
+
+def compile_roster(file_name, target=None, verbose=0):
+    target = target or compiled_path(file_name)
+    with open(file_name, 'r') as people:
+        roster = parse_roster(people)
+
+    os.makedirs(target, exist_ok=True)
+    meta_name = os.path.join(target, 'source.json')
+    # remove the stamp first so a partly written directory is never trusted
+    if os.path.exists(meta_name):
+        os.remove(meta_name)
+
+    columns = {'family': roster.family, 'category': roster.category, 'family_sizes': roster.family_sizes,
+               'name_offsets': roster.names.offsets, 'name_blob': roster.names.blob}
+    for column in COMPILED_COLUMNS:
+        np.save(os.path.join(target, column + '.npy'), columns[column])
+    rating_name = os.path.join(target, 'rating.npy')
+    if roster.rating is not None:
+        np.save(rating_name, roster.rating)
+    elif os.path.exists(rating_name):
+        os.remove(rating_name)
+
+    with open(meta_name, 'w') as meta:
+        json.dump(source_stamp(file_name, True), meta)
+
+    if verbose:
+        lp(f'Compiled {len(roster):,} people from "{file_name}" to "{target}"')
+    return roster
+
+def load_compiled(target):
+    columns = {column: np.load(os.path.join(target, column + '.npy'), mmap_mode='r')
+               for column in COMPILED_COLUMNS}
+    rating_name = os.path.join(target, 'rating.npy')
+    rating = np.load(rating_name, mmap_mode='r') if os.path.exists(rating_name) else None
+    return Roster(NameTable(columns['name_offsets'], columns['name_blob']),
+                  np.arange(len(columns['family']), dtype=np.int32), columns['family'],
+                  columns['category'], columns['family_sizes'], rating)
+
+# Returns the compiled roster for a text file, (re)compiling it when the text has changed.
+# A touched but otherwise unchanged file only has its stamp refreshed
+def compiled_roster(file_name, target=None, verbose=0):
+    target = target or compiled_path(file_name)
+    meta_name = os.path.join(target, 'source.json')
+    try:
+        with open(meta_name, 'r') as meta:
+            stamp = json.load(meta)
+    except (OSError, ValueError):
+        return compile_roster(file_name, target, verbose)
+
+    current = source_stamp(file_name, False)
+    if current['size'] != stamp.get('size'):
+        return compile_roster(file_name, target, verbose)
+
+    if current['mtime_ns'] != stamp.get('mtime_ns'):
+        current = source_stamp(file_name, True)
+        if current['sha256'] != stamp.get('sha256'):
+            return compile_roster(file_name, target, verbose)
+        with open(meta_name, 'w') as meta:
+            json.dump(current, meta)
 
-        if count == args.tries:
-            usage_error(f"Did not create valid teams in {count:,} attempts. Consider using the 'oktogether'' or 'tries' options")
+    try:
+        return load_compiled(target)
+    except (OSError, ValueError):
+        return compile_roster(file_name, target, verbose)
+
+
+# With a time limit, searches keep the try with the fewest conflicts (people on a team with
+# someone from their family) to fall back on, and stop once time.time() passes ends
+class BestTry:
+    def __init__(self, ends):
+        self.ends = ends
+        self.conflicts = None
+        self.teams = None
+
+    # teams is only called to make the teams when this try is the best so far
+    def offer(self, conflicts, teams):
+        if self.conflicts is None or conflicts < self.conflicts:
+            self.conflicts = conflicts
+            self.teams = teams()
+
+    def expired(self):
+        return time.time() > self.ends
+
+
+# Runs up to tries attempts at creating teams with no family conflicts. Returns the teams
+# (arrays of roster rows), the number of failed tries and the swaps repair_conflicts made
+# on the try that worked. Teams is None when the tries ran out, another worker set stop
+# or best (a BestTry, which is offered each failed try) ran out of time
+def search_teams(args, roster, categories, team_count, tries, rng, stats, stop=None, best=None):
+    count = 0
+    # the slot layout never changes between tries, so every engine works it out once. The
+    # random engine then shuffles each category's range of slots in place in one buffer
+    layout = team_layout(roster, categories, team_count, args.generations)
+    people, slot_team, starts = layout
+    if args.engine == 'constructive' and not args.oktogether:
+        slots, families = layout_families(roster, layout)
+    else:
+        shuffled = people.copy()
+    stats.lap('balance')
 
+    # need to make this better than brute force someday
+    while count < tries:
+        if stop is not None and stop.is_set():
+            break
+        if args.deadline is not None and time.time() > args.deadline:
+            break
+        # keep going until there is at least one try to fall back on
+        if best is not None and best.teams is not None and best.expired():
+            break
 
-    if args.verbose:
-        lp(f'\n~~~~ Results: {team_count} team{"s" if team_count > 1 else ""}, {remaining_count} people{" (" +str(drop_count)+ " dropped)" if args.drop else ""}, {category_count} {"category" if category_count ==1 else "categories"}. Took {count+1} {"try" if count ==0 else "tries"}~~~~')
+        if args.engine == 'batch' and not args.oktogether:
+            # keep batches from running past the tries budget
+            batch_size = min(batch_size_for(len(layout[0])), tries - count)
+
+            block, found, fewest = batch_tries(roster, layout, batch_size, rng, stats)
+            stats.lap('conflicts')
+            if found is not None:
+                stats.fail('conflict', found)
+                return layout_teams(layout, block[found], team_count), count + found, 0
+
+            # no row was valid, so try to fix the one with the fewest conflicts
+            repairs = repair_conflicts(roster, layout, block[fewest], rng)
+            stats.lap('repair')
+            if repairs is not None:
+                stats.fail('conflict', fewest)
+                return layout_teams(layout, block[fewest], team_count), count + fewest, repairs
+
+            if best is not None:
+                best.offer(conflict_count(slot_team, roster.family[block[fewest]]),
+                           lambda: layout_teams(layout, block[fewest], team_count))
+            stats.fail('conflict', batch_size)
+            count += batch_size
+            if args.verbose > 1:
+                lp(f'tries {count - batch_size + 1:,} to {count:,} failed due to conflicts')
+            continue
+
+        if args.engine == 'constructive' and not args.oktogether:
+            forced = [] if best is not None else None
+            placed, unseated = seat_families({cat: cat_slots.copy() for cat, cat_slots in slots.items()},
+                                             [members.copy() for members in families], team_count, rng, forced)
+            stats.lap('conflicts')
+            if placed is not None and not forced:
+                return [np.array(t, dtype=np.int32) for t in placed], count, 0
+
+            if forced:
+                best.offer(len(forced), lambda: [np.array(t, dtype=np.int32) for t in placed])
+                unseated = forced[0]
+            stats.fail('unplaced', families=[int(roster.family[unseated])])
+            count += 1
+            if args.verbose > 1:
+                lp(f'try {count:,} failed to place every family on distinct teams')
+        else:
+            for start, end in zip(starts[:-1], starts[1:]):
+                rng.shuffle(shuffled[start:end])
+            stats.lap('shuffle')
+            if args.oktogether:
+                return layout_teams(layout, shuffled, team_count), count, 0
+
+            bad_teams, bad_fams = find_conflicts(slot_team, roster.family[shuffled])
+            stats.lap('conflicts')
+            if len(bad_teams) == 0:
+                return layout_teams(layout, shuffled, team_count), count, 0
+
+            repairs = repair_conflicts(roster, layout, shuffled, rng)
+            stats.lap('repair')
+            if repairs is not None:
+                return layout_teams(layout, shuffled, team_count), count, repairs
+
+            if best is not None:
+                best.offer(conflict_count(slot_team, roster.family[shuffled]),
+                           lambda: layout_teams(layout, shuffled, team_count))
+            stats.fail('conflict', families=bad_fams.tolist())
+            count += 1
+            if args.verbose > 1:
+                lp(f'try {count:,} failed due to {len(bad_teams)} conflicts {roster.team_names(shuffled[slot_team == bad_teams[0]])}')
+
+    return None, count, 0
+
+
+# Rosters up to this many people are teamed in plain python by small_search
+SMALL_ROSTER = 500
+
+# The constructive search (or an oktogether shuffle) for small rosters in plain python. It
+# works out the teams of each category's slots once with slot_layout, then each try only
+# seats families into them. Returns lists of rows like search_teams returns arrays
+def small_search(args, roster, categories, team_count, tries, rng, stats, best=None):
+    count = 0
+    slots = slot_layout([len(cat) for cat in categories], team_count, args.generations)
+    families = {}
+    for cat_num, cat in enumerate(categories):
+        for person in cat:
+            families.setdefault(roster.family[person], []).append((cat_num, person))
+    stats.lap('balance')
+
+    while count < tries:
+        if args.deadline is not None and time.time() > args.deadline:
+            break
+        # keep going until there is at least one try to fall back on
+        if best is not None and best.teams is not None and best.expired():
+            break
 
-    # take doesn't work with inhomogeneous shape arrays, so loop
-    out_teams = []
-    for t in teams:
-        # sort the team by the people's original category
-        # (sorting in numpy is a bit tricky)
-        cat_nums = np.take(t, 2, 1)
-        t = t[np.argsort(cat_nums)]
+        if args.oktogether:
+            teams = [[] for _ in range(team_count)]
+            for cat, cat_slots in zip(categories, slots):
+                cat = cat.copy()
+                rng.shuffle(cat)
+                for person, t_num in zip(cat, cat_slots):
+                    teams[t_num].append(person)
+            return teams, count
+
+        forced = [] if best is not None else None
+        teams, unseated = seat_families({cat_num: cat_slots.copy() for cat_num, cat_slots in enumerate(slots)},
+                                        [members.copy() for members in families.values()], team_count, rng, forced)
+        stats.lap('conflicts')
+        if teams is not None and not forced:
+            return teams, count
+
+        if forced:
+            best.offer(len(forced), lambda: teams)
+            unseated = forced[0]
+
+        stats.fail('unplaced', families=[roster.family[unseated]])
+        count += 1
+        if args.verbose > 1:
+            lp(f'try {count:,} failed to place every family on distinct teams')
+
+    return None, count
+
+# Returns the team of every slot of each category, the same teams split_slots would put
+# that category's people on (it splits by position, so who is in a slot doesn't matter)
+def slot_layout(cat_sizes, team_count, generations):
+    labels = [[cat_num] * size for cat_num, size in enumerate(cat_sizes)]
+    if generations:
+        labels = [[label for cat in labels for label in cat]]
+    else:
+        balance_categories(labels, team_count)
+
+    slots = [[] for _ in cat_sizes]
+    for cat in labels:
+        for t_num, part in enumerate(split_list(cat, team_count)):
+            for label in part:
+                slots[label].append(t_num)
+    return slots
+
+# Number of slots each category has on each team, from slot_layout for small rosters and
+# from one split_slots of category labels otherwise
+def slot_counts(cat_sizes, team_count, generations, small):
+    if small:
+        counts = [[0] * team_count for _ in cat_sizes]
+        for cat_counts, cat_slots in zip(counts, slot_layout(cat_sizes, team_count, generations)):
+            for t_num in cat_slots:
+                cat_counts[t_num] += 1
+        return counts
+
+    labels = [np.full(size, cat_num, dtype=np.int32) for cat_num, size in enumerate(cat_sizes)]
+    people, team_ids = split_slots(labels, team_count, generations)
+    return np.bincount(people.astype(np.int64) * team_count + team_ids,
+                       minlength=len(cat_sizes) * team_count).reshape(len(cat_sizes), team_count)
+
+# Same sizes as np.array_split, the first len % parts parts are one longer
+def split_list(items, parts):
+    size, longer = divmod(len(items), parts)
+    start = 0
+    for part in range(parts):
+        end = start + size + (part < longer)
+        yield items[start:end]
+        start = end
+
+# Plain python plan_drops for small rosters, returns the categories without the dropped
+def small_plan_drops(roster, categories, team_count, drop_count, oktogether, rng):
+    if oktogether:
+        drops = set(rng.sample([person for cat in categories for person in cat], drop_count))
+    else:
+        members = {}
+        for cat in categories:
+            for person in cat:
+                members.setdefault(roster.family[person], []).append(person)
+        sizes = [len(rows) for rows in members.values()]
+        level = drop_level(lambda cap: sum(size - cap for size in sizes if size > cap), team_count, drop_count)
+
+        drops = set()
+        at_level = []
+        for rows in members.values():
+            rng.shuffle(rows)
+            drops.update(rows[level:])
+            if len(rows) >= level:
+                at_level.append(rows[level - 1])
+        drops.update(rng.sample(at_level, drop_count - len(drops)))
+
+    return [[person for person in cat if person not in drops] for cat in categories]
+
+# Splits the tries across a pool of processes, each with its own random stream spawned
+# from one SeedSequence. The family and category columns are put in shared memory rather
+# than pickled to every worker (workers never need names). The first worker to succeed
+# sets the stop event so the rest give up, and the failed tries of all workers are summed
+def parallel_search(args, roster, categories, team_count, stats):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from multiprocessing import shared_memory
+    workers = min(args.workers, max(args.tries, 1))
+    people_count = len(roster)
+    shm = shared_memory.SharedMemory(create=True, size=max(people_count * 6, 1))
+    try:
+        family = np.ndarray(people_count, dtype=np.int32, buffer=shm.buf)
+        family[:] = roster.family
+        category = np.ndarray(people_count, dtype=np.int16, buffer=shm.buf, offset=people_count * 4)
+        category[:] = roster.category
+        del family, category
+
+        worker_args = copy(args)
+        worker_args.verbose = 0
+        seeds = np.random.SeedSequence(args.seed).spawn(workers)
+        stop = multiprocessing.get_context().Event()
+
+        teams = None
+        count = 0
+        repairs = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(stop,)) as pool:
+            futures = [pool.submit(_search_worker, shm.name, people_count, worker_args, team_count,
+                                   args.tries // workers + (w < args.tries % workers), seeds[w])
+                       for w in range(workers)]
+            for future in as_completed(futures):
+                w_teams, w_count, w_repairs, w_stats = future.result()
+                count += w_count
+                if w_stats is not None:
+                    stats.merge(w_stats)
+                if w_teams is not None and teams is None:
+                    teams = w_teams
+                    repairs = w_repairs
+                    stop.set()
+
+        if args.verbose > 1:
+            lp(f'{workers} workers ran {count + (teams is not None):,} tries')
+        return teams, count, repairs
+    finally:
+        shm.close()
+        shm.unlink()
 
-        out_teams.append(np.take(t, 0, 1))
 
-    # Result is a dict, the teams value it either a plain string of team of a json string
-    result = { 'team_count' : team_count, 'player_count': remaining_count,
-              'category_count': category_count, 'drop_count': drop_count, 'tries': count+1 }
-    if args.json:
-        result['teams'] = json.dumps([t.tolist() for t in out_teams])
+_stop_event = None
+
+def _init_worker(stop):
+    global _stop_event
+    _stop_event = stop
+
+def _search_worker(shm_name, people_count, args, team_count, tries, seed):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return _search_shared(shm, people_count, args, team_count, tries, seed)
+    finally:
+        shm.close()
+
+# separate from _search_worker so every view of the shared buffer is gone before it is closed
+def _search_shared(shm, people_count, args, team_count, tries, seed):
+    family = np.ndarray(people_count, dtype=np.int32, buffer=shm.buf)
+    category = np.ndarray(people_count, dtype=np.int16, buffer=shm.buf, offset=people_count * 4)
+    roster = Roster(None, None, family, category, None)
+    stats = Stats() if args.stats else NO_STATS
+    teams, count, repairs = search_teams(args, roster, roster.categories(), team_count, tries,
+                                         np.random.default_rng(seed), stats, _stop_event)
+    if teams is not None:
+        _stop_event.set()
+    return teams, count, repairs, (stats.as_dict() if args.stats else None)
+
+
+# Times each pair of people has been on a team together. A dense matrix for rosters up to
+# DENSE_PAIRS people, otherwise a dict of the pairs seen so far. Either way a round only
+# adds its own pairs. Rows are roster rows plus pad, which pads teams to one width and is
+# never counted
+DENSE_PAIRS = 4096
+
+class PairCounts:
+    def __init__(self, people_count):
+        self.pad = people_count
+        if people_count <= DENSE_PAIRS:
+            self.matrix = np.zeros((people_count + 1, people_count + 1), dtype=np.uint16)
+        else:
+            self.matrix = None
+            self.pairs = {}
+
+    # counts of the pairs a[i], b[i] (arrays of the same shape)
+    def lookup(self, a, b):
+        if self.matrix is not None:
+            # signed, so callers can take differences
+            return self.matrix[a, b].astype(np.int64)
+        a, b = np.broadcast_arrays(a, b)
+        keys = np.minimum(a, b).astype(np.int64) * (self.pad + 1) + np.maximum(a, b)
+        return np.fromiter((self.pairs.get(key, 0) for key in keys.ravel().tolist()), dtype=np.int64,
+                           count=keys.size).reshape(keys.shape)
+
+    # members holds one team per row, padded with pad
+    def add(self, members):
+        for i in range(members.shape[1]):
+            for j in range(i + 1, members.shape[1]):
+                a, b = members[:, i], members[:, j]
+                real = (a != self.pad) & (b != self.pad)
+                a, b = a[real], b[real]
+                if self.matrix is not None:
+                    # no pair shows up twice in one round, so plain fancy indexing adds them all
+                    self.matrix[a, b] += 1
+                    self.matrix[b, a] += 1
+                else:
+                    for key in (np.minimum(a, b).astype(np.int64) * (self.pad + 1) + np.maximum(a, b)).tolist():
+                        self.pairs[key] = self.pairs.get(key, 0) + 1
+
+
+# Most sweeps of swap proposals per round, each offers every person one swap. Sweeps stop
+# early once none of the proposals helps
+ROUND_SWEEPS = 32
+
+# Several rounds of teams for the same roster. Each round starts from a search like a single
+# request, then sweeps of swaps between same category people on different teams move people
+# away from teammates they already had, without putting family members together. Returns
+# the teams of each round (as far as it got), the tries (including the ones that worked)
+# and repairs of all rounds and the number of repeat pairs in the rounds
+def tournament(args, roster, categories, team_count, rng, stats):
+    pairs = PairCounts(len(roster))
+    family = np.append(roster.family, -1)
+    rounds = []
+    count = repairs = repeats = 0
+    for r_num in range(args.rounds):
+        teams, r_count, r_repairs = search_teams(args, roster, categories, team_count, args.tries, rng, stats)
+        count += r_count
+        if teams is None:
+            break
+        count += 1
+        repairs += r_repairs
+
+        members = pad_teams(teams, pairs.pad)
+        swaps = spread_pairs(members, pairs, family, categories, args.oktogether, rng)
+        stats.lap('rounds')
+        r_repeats = int((pairs.lookup(members[:, :, None], members[:, None, :]) > 0).sum() // 2)
+        repeats += r_repeats
+        pairs.add(members)
+        rounds.append([team[team != pairs.pad] for team in members])
+        if args.verbose > 1:
+            lp(f'round {r_num + 1}: {r_repeats} repeat pairs after {swaps} swaps')
+        stats.lap('rounds')
+
+    return rounds, count, repairs, repeats
+
+# Teams as the rows of one matrix, shorter teams padded with pad
+def pad_teams(teams, pad):
+    sizes = np.array([len(t) for t in teams])
+    members = np.full((len(teams), sizes.max()), pad, dtype=np.int64)
+    members[np.arange(sizes.max()) < sizes[:, None]] = np.concatenate(teams)
+    return members
+
+# Each sweep pairs everyone at random with someone of their category, and every pair on
+# different teams where swapping lowers the count of earlier pairings (and brings no family
+# member onto a team) is a candidate. Candidates are taken best first, at most one swap per
+# team per sweep so their gains stay exact. Works on members in place, returns the swaps
+def spread_pairs(members, pairs, family, categories, oktogether, rng):
+    team_of = np.empty(pairs.pad + 1, dtype=np.int64)
+    slot_of = np.empty(pairs.pad + 1, dtype=np.int64)
+    team_of[members] = np.arange(len(members))[:, None]
+    slot_of[members] = np.arange(members.shape[1])[None, :]
+
+    swaps = 0
+    for _ in range(ROUND_SWEEPS):
+        x = np.concatenate([np.asarray(cat) for cat in categories])
+        y = np.concatenate([rng.permutation(cat) for cat in categories])
+        apart = team_of[x] != team_of[y]
+        x, y = x[apart], y[apart]
+        x_team, y_team = members[team_of[x]], members[team_of[y]]
+
+        # earlier pairings with the current team, and with the other team once swapped
+        x_now = pairs.lookup(x[:, None], x_team).sum(1)
+        y_now = pairs.lookup(y[:, None], y_team).sum(1)
+        x_then = pairs.lookup(x[:, None], y_team).sum(1) - pairs.lookup(x, y)
+        y_then = pairs.lookup(y[:, None], x_team).sum(1) - pairs.lookup(x, y)
+        gain = x_now + y_now - x_then - y_then
+
+        ok = gain > 0
+        if not oktogether:
+            ok &= ~((family[y_team] == family[x][:, None]) & (y_team != y[:, None])).any(1)
+            ok &= ~((family[x_team] == family[y][:, None]) & (x_team != x[:, None])).any(1)
+        if not ok.any():
+            break
+
+        used = set()
+        for i in np.flatnonzero(ok)[np.argsort(-gain[ok], kind='stable')].tolist():
+            a, b = int(x[i]), int(y[i])
+            a_team, b_team = int(team_of[a]), int(team_of[b])
+            if a_team in used or b_team in used:
+                continue
+            used.update((a_team, b_team))
+            members[a_team, slot_of[a]], members[b_team, slot_of[b]] = b, a
+            team_of[a], team_of[b] = b_team, a_team
+            slot_of[a], slot_of[b] = slot_of[b], slot_of[a]
+            swaps += 1
+
+    return swaps
+
+
+# Teams with close rating totals. Each category is dealt out best first in snake order
+# (1, 2, .. n, n, .. 2, 1), continuing the snake from one category to the next. Families
+# the deal put together are fixed with repair_conflicts, or if that fails the teams come
+# from a normal search. balance_ratings then swaps people to close the gaps. Unrated
+# people count as the average rating. Returns the teams, the failed tries, the repair swaps
+# and the spread between the highest and lowest team totals
+def balanced_search(args, roster, categories, team_count, rng, stats):
+    rating = np.asarray(roster.rating, dtype=np.float64)
+    rated = ~np.isnan(rating)
+    rating = np.where(rated, rating, rating[rated].mean() if rated.any() else 0)
+
+    layout = team_layout(roster, categories, team_count, args.generations)
+    people = snake_seed(rating, layout, team_count)
+    count = 0
+    repairs = 0 if args.oktogether else repair_conflicts(roster, layout, people, rng)
+    stats.lap('ratings')
+    if repairs is None:
+        teams, count, repairs = search_teams(args, roster, categories, team_count, args.tries, rng, stats)
+        if teams is None:
+            return None, count, repairs, None
     else:
-        team_list = []
-        for t in out_teams:
-            team_list.append(args.separator.join(t))
-        result['teams'] = '\n'.join(team_list)
+        teams = layout_teams(layout, people, team_count)
+
+    pad = len(roster)
+    members = pad_teams(teams, pad)
+    swaps = balance_ratings(members, np.append(rating, 0), np.append(roster.family, -1),
+                            np.append(roster.category, -1), args.oktogether, rng)
+    totals = np.append(rating, 0)[members].sum(1)
+    if args.verbose > 1:
+        lp(f'{swaps} swaps to balance ratings')
+    stats.lap('ratings')
+    return [team[team != pad] for team in members], count, repairs, round(float(totals.max() - totals.min()), 6)
+
+# The layout's people dealt out by rating, best first, to each category's slots in snake
+# order of teams
+def snake_seed(rating, layout, team_count):
+    people, slot_team, starts = layout
+    seeded = np.empty_like(people)
+    offset = 0
+    for start, end in zip(starts[:-1], starts[1:]):
+        teams = slot_team[start:end]
+        by_team = np.argsort(teams, kind='stable')
+        # turn is which of its team's slots in this category a slot is
+        turn = np.empty(end - start, dtype=np.int64)
+        turn[by_team] = np.arange(end - start) - np.searchsorted(teams[by_team], teams[by_team])
+        turn += offset
+        place = np.where(turn % 2 == 0, teams, team_count - 1 - teams)
+        slots = start + np.lexsort((place, turn))
+        cat_people = people[start:end]
+        seeded[slots] = cat_people[np.argsort(-rating[cat_people], kind='stable')]
+        offset = int(turn.max()) + 1 if len(turn) else offset
+    return seeded
+
+# Most sweeps of balance_ratings, which stops early after BALANCE_IDLE sweeps in a row
+# without a swap
+BALANCE_SWEEPS = 400
+BALANCE_IDLE = 8
+
+# Pairs each team with one of the opposite rank (the highest with the lowest and so on, or
+# on alternate sweeps at random, since the best pair may have no useful swap) and makes
+# the best swap between each pair: same category, no family member brought onto a team,
+# and the largest drop in the sum of squared team totals. Team pairs never share a team
+# so all of a sweep's swaps are made at once. Works on members (padded teams, pad being
+# the last row of the rating, family and category columns) in place, returns the swaps
+def balance_ratings(members, rating, family, category, oktogether, rng):
+    team_count = len(members)
+    pad = len(rating) - 1
+    rows = np.arange(team_count)
+    swaps = 0
+    idle = 0
+    for sweep in range(BALANCE_SWEEPS):
+        totals = rating[members].sum(1)
+        if sweep % 2:
+            rank = rng.permutation(team_count)
+            high, low = rank[:team_count // 2], rank[team_count // 2:2 * (team_count // 2)]
+            flip = totals[high] < totals[low]
+            high, low = np.where(flip, low, high), np.where(flip, high, low)
+        else:
+            rank = np.argsort(totals, kind='stable')
+            high = rank[team_count - team_count // 2:][::-1]
+            low = rank[:team_count // 2]
+        first, second = members[high], members[low]
+
+        # d[t, i, j] is the change to the high team's total from swapping its i with low's j
+        d = rating[second][:, None, :] - rating[first][:, :, None]
+        gain = -d * (totals[high] - totals[low])[:, None, None] - d * d
+        valid = ((category[first][:, :, None] == category[second][:, None, :])
+                 & (first != pad)[:, :, None] & (second != pad)[:, None, :])
+        if not oktogether:
+            # family of i already on the low team (other than j), or of j on the high team
+            i_on_low = family[first][:, :, None] == family[second][:, None, :]
+            valid &= (i_on_low.sum(2, keepdims=True) - i_on_low) == 0
+            j_on_high = family[second][:, None, :] == family[first][:, :, None]
+            valid &= (j_on_high.sum(1, keepdims=True) - j_on_high) == 0
+        gain = np.where(valid, gain, 0)
+
+        best = gain.reshape(len(high), -1).argmax(1)
+        i, j = np.divmod(best, members.shape[1])
+        take = gain.reshape(len(high), -1)[rows[:len(high)], best] > 1e-9
+        if not take.any():
+            idle += 1
+            if idle == BALANCE_IDLE:
+                break
+            continue
+        idle = 0
+        high, low, i, j = high[take], low[take], i[take], j[take]
+        moving = members[high, i]
+        members[high, i] = members[low, j]
+        members[low, j] = moving
+        swaps += int(take.sum())
+
+    return swaps
+
+
+# balance_categories works on lists (small rosters) and numpy arrays
+def join(first, second):
+    if isinstance(first, list):
+        return first + second
+    return np.append(first, second, 0)
 
-    return result
 
 # When teams are created they are created "accross" categories so that categories are
 # spread out as evenly as possible. To even sized teams, however, that cannot alawys be
@@ -250,9 +1869,9 @@ def balance_categories(categories, team_count):
         if extra > 0:
 #            print(f'pushing: {extra}')
             if cat_num == len(categories) - 1:
-                categories.append(np.empty((0, 3)))
+                categories.append(cat[:0])
 
-            categories[cat_num+1] = np.append(categories[cat_num+1], cat[-extra:], 0)
+            categories[cat_num+1] = join(categories[cat_num+1], cat[-extra:])
             categories[cat_num] = cat[:team_count]
         cat_num += 1
         if cat_num == len(categories):
@@ -275,41 +1894,429 @@ def balance_categories(categories, team_count):
             if avail > 0:
                 short -= avail
 #                print(f'remaining: {short}')
-                categories[cat_num] = cat = np.append(cat, cat_from[:avail], 0)
+                categories[cat_num] = cat = join(cat, cat_from[:avail])
                 categories[pull_from] = cat_from[avail:]
             pull_from += 1
 
 #    print(f'cats2:{[len(cat) for cat in categories]} {categories}')
 
 
-def do_drop(categories_in, drop_count, verbose):
-    categories_out = categories_in.copy()
-    if drop_count > 0:
-        if verbose:
-            lp(f'(re)dropping {drop_count} {"people" if drop_count > 1 else "person"}')
-
-        drop_index = []
-        people_count = 0
-        for cat_num, cat in enumerate(categories_out):
-            for p_num, _ in enumerate(cat):
-                drop_index.append((cat_num, p_num))
-                people_count += 1
+# Rather than throwing away a shuffle that put family members together, seat families
+# into the team slots the category split creates. A slot stays tied to its category, so
+# category spreading is unchanged. Returns the teams of each category's slots and the
+# (category, person) members of each family, for seat_families to use up on every try
+def layout_families(roster, layout):
+    people, slot_team, _ = layout
+    slots = {}
+    families = {}
+    for person, t_num, fam, cat in zip(people.tolist(), slot_team.tolist(), roster.family[people].tolist(),
+                                       roster.category[people].tolist()):
+        slots.setdefault(cat, []).append(t_num)
+        families.setdefault(fam, []).append((cat, person))
+    return slots, list(families.values())
+
+# slots maps each category to the teams of its open slots and families holds the (category,
+# person) members of each family. Both are used up. The largest families are seated first
+# since they have the fewest valid choices, and within a family the people whose category
+# reaches the fewest teams go first. Returns the people of each team, or None and the
+# person who could not be seated (caller tries again). Given a forced list, people who
+# cannot be seated apart from their family take any open slot of their category instead
+# and are added to it, so the try still ends with teams that have len(forced) conflicts
+def seat_families(slots, families, team_count, rng, forced=None):
+    for cat_slots in slots.values():
+        rng.shuffle(cat_slots)
+
+    reach = {cat: len(set(cat_slots)) for cat, cat_slots in slots.items()}
+    fam_order = families
+    rng.shuffle(fam_order)
+    fam_order.sort(key=len, reverse=True)
+
+    placed = [[] for _ in range(team_count)]
+    for members in fam_order:
+        members.sort(key=lambda member: reach[member[0]])
+        used = set()
+        for cat, person in members:
+            cat_slots = slots[cat]
+            for s_num, t_num in enumerate(cat_slots):
+                if t_num not in used:
+                    break
+            else:
+                if forced is None:
+                    return None, person
+                s_num, t_num = 0, cat_slots[0]
+                forced.append(person)
+
+            # swap-pop so removal from the open slot list stays O(1)
+            cat_slots[s_num] = cat_slots[-1]
+            cat_slots.pop()
+            used.add(t_num)
+            placed[t_num].append(person)
+
+    return placed, None
+
+
+# Splits each category across teams, either spreading categories out (after balancing
+# them) or keeping them together when categories compete. Returns the people in category
+# order along with the team number of each, worked out with arithmetic rather than a
+# split per team so it stays cheap with hundreds of thousands of teams
+def split_slots(categories, team_count, generations):
+    if generations:
+        categories = [np.concatenate(categories)]
+    else:
+        categories = list(categories)
+        balance_categories(categories, team_count)
+
+    people = np.concatenate(categories)
+    team_ids = np.concatenate([split_ids(len(cat), team_count) for cat in categories])
+    return people, team_ids
+
+# Team of each position when n items are split like np.array_split(items, parts), where the
+# first n % parts parts are one longer
+def split_ids(n, parts):
+    size, longer = divmod(n, parts)
+    positions = np.arange(n, dtype=np.int32)
+    edge = longer * (size + 1)
+    return np.where(positions < edge, positions // (size + 1),
+                    longer + (positions - edge) // max(size, 1)).astype(np.int32)
+
+
+# Category sizes fix which team every category "slot" ends up on, so one split of the
+# unshuffled categories gives the layout for every try. Returns the people grouped by
+# their category, the team of each of those slots, and where each category starts. A
+# try is then just a permutation of people within their category's range of slots
+def team_layout(roster, categories, team_count, generations):
+    people, team_ids = split_slots(categories, team_count, generations)
+    order = np.lexsort((team_ids, roster.category[people]))
+    starts = np.cumsum([0] + [len(cat) for cat in categories])
+    return people[order], team_ids[order], starts
+
+
+def layout_teams(layout, people, team_count):
+    _, slot_team, _ = layout
+    order = np.argsort(slot_team, kind='stable')
+    bounds = np.cumsum(np.bincount(slot_team, minlength=team_count))[:-1]
+    return np.split(people[order], bounds)
+
+
+# Keeps one batch of tries (the people block plus the int64 sort keys) near this size
+BATCH_BYTES = 64 * 1024 * 1024
+MAX_BATCH = 4096
+
+def batch_size_for(people_count):
+    return max(1, min(MAX_BATCH, BATCH_BYTES // (24 * max(people_count, 1))))
+
+# Generates batch_size tries at once, one row per try, by permuting a tiled copy of each
+# category's people along its rows, then checks every row for family conflicts with one
+# sort. Returns the block of tries, the index of the first valid row (or None) and the
+# index of the row with the fewest conflicts
+def batch_tries(roster, layout, batch_size, rng, stats):
+    people, slot_team, starts = layout
+    block = np.empty((batch_size, len(people)), dtype=np.int32)
+    for start, end in zip(starts[:-1], starts[1:]):
+        block[:, start:end] = rng.permuted(np.tile(people[start:end], (batch_size, 1)), axis=1)
+
+    if len(people) < 2:
+        return block, 0, 0
+
+    width = np.int64(roster.family.max()) + 1
+    keys = slot_team.astype(np.int64) * width + roster.family[block]
+    keys.sort(axis=1)
+    dups = keys[:, 1:] == keys[:, :-1]
+    valid = np.flatnonzero(~np.any(dups, axis=1))
+    if isinstance(stats, Stats):
+        # only the rows up to the first valid one count as tried
+        tried = valid[0] if len(valid) else batch_size
+        families, counts = np.unique(keys[:tried, 1:][dups[:tried]] % width, return_counts=True)
+        stats.family_counts(families.tolist(), counts.tolist())
+    if len(valid):
+        return block, int(valid[0]), int(valid[0])
+    return block, None, int(np.argmin(dups.sum(axis=1)))
+
+
+# A try with a few conflicts is nearly valid, so rather than throw it away move each
+# conflicting person to a random other slot of their category whose team has none of their
+# family, swapping with someone whose family is not on their team either. Every swap then
+# removes one conflict and adds none, keeping team sizes and category spreading. Works on
+# people in place and returns the number of swaps, or None if there were more conflicts
+# than repair_budget allows or someone found no partner in REPAIR_PROBES random picks
+REPAIR_PROBES = 32
+
+def repair_budget(people_count):
+    return max(16, people_count // 10)
+
+def repair_conflicts(roster, layout, people, rng):
+    _, slot_team, starts = layout
+    family = roster.family[people]
+    width = np.int64(roster.family.max()) + 1
+    keys = slot_team.astype(np.int64) * width + family
+    order = np.argsort(keys, kind='stable')
+    # every slot after the first of its family on its team has to move
+    moving = order[1:][keys[order[1:]] == keys[order[:-1]]]
+    if len(moving) > repair_budget(len(people)):
+        return None
+
+    counts = {}
+    for key in keys[order].tolist():
+        counts[key] = counts.get(key, 0) + 1
+
+    swaps = 0
+    ranges = np.searchsorted(starts, moving, side='right') - 1
+    for slot, cat_num in zip(moving.tolist(), ranges.tolist()):
+        team, fam = int(slot_team[slot]), int(family[slot])
+        if counts[team * width + fam] < 2:
+            # an earlier swap already moved this one's relative away
+            continue
+        for other in rng.integers(starts[cat_num], starts[cat_num + 1], REPAIR_PROBES).tolist():
+            o_team, o_fam = int(slot_team[other]), int(family[other])
+            if counts.get(team * width + o_fam, 0) == 0 and counts.get(o_team * width + fam, 0) == 0:
+                break
+        else:
+            return None
+
+        for key, change in ((team * width + fam, -1), (o_team * width + o_fam, -1),
+                            (team * width + o_fam, 1), (o_team * width + fam, 1)):
+            counts[key] = counts.get(key, 0) + change
+        people[slot], people[other] = people[other], people[slot]
+        family[slot], family[other] = o_fam, fam
+        swaps += 1
+    return swaps
+
+
+# Finds every team that holds more than one person from the same family in one sort over
+# the whole assignment. Returns matching arrays of the conflicting teams and families
+# (each pair once, ordered by team), so both are empty when the assignment is valid
+def find_conflicts(team_ids, family_ids):
+    if len(family_ids) < 2:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+    width = np.int64(family_ids.max()) + 1
+    keys = np.sort(team_ids.astype(np.int64) * width + family_ids)
+    dups = np.unique(keys[1:][keys[1:] == keys[:-1]])
+    return (dups // width).astype(np.int32), (dups % width).astype(np.int32)
+
+
+# Number of people on a team with someone from their family (the first of a family on a
+# team does not count), the measure BestTry keeps the lowest of
+def conflict_count(team_ids, family_ids):
+    if len(family_ids) < 2:
+        return 0
+    width = np.int64(family_ids.max()) + 1
+    keys = np.sort(team_ids.astype(np.int64) * width + family_ids)
+    return int(np.count_nonzero(keys[1:] == keys[:-1]))
+
+# Names of the people of each family that shares a team, one list per family and team
+def team_conflicts(roster, teams, small):
+    if small:
+        conflicts = []
+        for team in teams:
+            members = {}
+            for row in team:
+                members.setdefault(roster.family[row], []).append(row)
+            conflicts.extend(roster.team_names(rows) for rows in members.values() if len(rows) > 1)
+        return conflicts
+
+    rows = np.concatenate(teams)
+    team_ids = np.repeat(np.arange(len(teams), dtype=np.int32), [len(t) for t in teams])
+    bad_teams, bad_fams = find_conflicts(team_ids, roster.family[rows])
+    return [roster.team_names(teams[t][roster.family[teams[t]] == f])
+            for t, f in zip(bad_teams.tolist(), bad_fams.tolist())]
+
+
+# Picks who to drop so that no family is larger than team_count afterwards, which the
+# up front check made possible. Drops come from the largest families first: every family
+# is cut down to one common size, and the few drops left over each take one more person
+# from families of that size. Who goes within a family is random, and oktogether drops are
+# simply random. Returns the rows of the people kept
+def plan_drops(roster, team_count, drop_count, oktogether, rng):
+    people_count = len(roster)
+    if oktogether:
+        return np.sort(rng.choice(people_count, people_count - drop_count, replace=False))
+
+    sizes = np.bincount(roster.family)
+    level = drop_level(lambda cap: int(np.maximum(sizes - cap, 0).sum()), team_count, drop_count)
+    keep = np.minimum(sizes, level)
+    at_level = np.flatnonzero(sizes >= level)
+    keep[rng.choice(at_level, drop_count - int((sizes - keep).sum()), replace=False)] -= 1
+
+    # random order within each family, then keep the first keep[family] of each
+    shuffled = rng.permutation(people_count)
+    shuffled = shuffled[np.argsort(roster.family[shuffled], kind='stable')]
+    starts = np.cumsum(sizes) - sizes
+    rank = np.arange(people_count) - np.repeat(starts, sizes)
+    return np.sort(shuffled[rank < np.repeat(keep, sizes)])
+
+# Most choices of who to drop before giving up. Planned drops (from the largest families)
+# and uniformly random ones take turns
+DROP_PLANS = 16
+
+# Capping family sizes is not always enough, the people left also have to fit the slot
+# layout their category sizes give. So each choice of drops is checked with
+# feasibility_problem and another one is made while a category (or the teams) is
+# binding. Returns the roster and categories without the dropped people
+def drop_people(roster, categories, team_count, drop_count, args, rng, small):
+    for plan in range(DROP_PLANS):
+        randomly = args.oktogether or plan % 2 == 1
+        if small:
+            kept_roster, kept = roster, small_plan_drops(roster, categories, team_count, drop_count, randomly, rng)
+        else:
+            kept_roster = roster.take(plan_drops(roster, team_count, drop_count, randomly, rng))
+            kept = kept_roster.categories()
+        if args.oktogether:
+            return kept_roster, kept
+
+        problem = feasibility_problem(kept_roster, kept, team_count, args.generations, small)
+        if problem is None:
+            return kept_roster, kept
+        if args.verbose > 1:
+            lp(f'drop choice {plan + 1} leaves no valid teams, {problem}')
+
+    usage_error(f"The people chosen to drop leave no valid teams in {DROP_PLANS} choices, the last because {problem}. Consider using the 'uneven' or 'oktogether' option")
+
+# Smallest family size cap (at most team_count) whose excess, the people above the cap,
+# fits in drop_count
+def drop_level(excess, team_count, drop_count):
+    low, high = 1, team_count
+    while low < high:
+        mid = (low + high) // 2
+        if excess(mid) <= drop_count:
+            high = mid
+        else:
+            low = mid + 1
+    return low
+
+
+# Says why no valid teams exist for the layout the search uses (None when they may), so a
+# request fails fast rather than letting the search spend every try. Within one category, family members need distinct teams, so
+# filling a category's slots is a simple bipartite degree problem (families on one side,
+# teams with that category's slot counts on the other) and the Gale-Ryser condition decides
+# it exactly. The same goes for families against whole teams. Both must hold, but passing
+# them does not prove a family's different categories can share out the teams together
+def feasibility_problem(roster, categories, team_count, generations, small):
+    counts = slot_counts([len(cat) for cat in categories], team_count, generations, small)
+    if small:
+        checks = list(zip(categories, counts)) + [([person for cat in categories for person in cat],
+                                                   [sum(team) for team in zip(*counts)])]
+    else:
+        checks = list(zip(categories, counts)) + [(np.arange(len(roster)), counts.sum(axis=0))]
+
+    for cat_num, (rows, places) in enumerate(checks):
+        if small:
+            need = {}
+            for person in rows:
+                need[roster.family[person]] = need.get(roster.family[person], 0) + 1
+            sizes = {}
+            for n in need.values():
+                sizes[n] = sizes.get(n, 0) + 1
+            capacity = sorted((p for p in places if p > 0), reverse=True)
+        else:
+            need = np.bincount(roster.family[rows])
+            sizes = np.bincount(need)
+            sizes = {n: int(sizes[n]) for n in np.flatnonzero(sizes[1:]) + 1}
+            capacity = np.sort(places[places > 0])[::-1][:max(sizes, default=0)].tolist()
+
+        binding = gale_ryser(sizes, capacity)
+        if binding is None:
+            continue
+
+        total, teams, fill = binding
+        if small:
+            capped = {fam for fam, n in need.items() if n > teams}
+        else:
+            capped = set(np.flatnonzero(need > teams).tolist())
+            rows = rows[np.isin(roster.family[rows], list(capped))]
+        first = {}
+        for person in rows:
+            fam = int(roster.family[person])
+            if fam in capped and fam not in first:
+                first[fam] = person
+                if len(first) == 3:
+                    break
+        names = roster.team_names(list(first.values()) if small else np.array(list(first.values()), dtype=np.int64))
+        families = f"the famil{'y' if len(names) == 1 else 'ies'} of {', '.join(names)}"
+
+        if cat_num < len(categories):
+            return f"category {cat_num + 1} has {total} places on {teams} team{'s' if teams > 1 else ''} but only {fill} of its people can fill them without family members sharing a team, because of {families}"
+        return f"the {teams} largest teams have {total} places but only {fill} people can fill them without family members sharing a team, because of {families}"
+    return None
+
+# sizes maps how many people a family must place (at most one per team) to the number of
+# such families, and capacity is the places on each team, largest first, with the same
+# total. A placement exists exactly when, for every j, the j largest teams need no more
+# than sum(min(need, j)) over families. Only j below the largest need can fail, so this is
+# a short loop. Returns None when the placement exists, otherwise the places on the j
+# largest teams, j and how many of those places the families can fill
+def gale_ryser(sizes, capacity):
+    places = 0
+    for j, cap in enumerate(capacity[:max(sizes, default=0)], 1):
+        places += cap
+        fill = sum(min(need, j) * count for need, count in sizes.items())
+        if places > fill:
+            return places, j, fill
+    return None
 
-        drops = sample(drop_index, drop_count)
-        for cat_num, cat in enumerate(categories_out):
-            cat_drops = list(filter(lambda d: d[0]==cat_num, drops))
-            if cat_drops:
-                people_drops = np.take(cat_drops, 1, 1)
-                categories_out[cat_num] = np.delete(categories_out[cat_num], people_drops, 0)
 
-        if verbose:
-            lp(f'{people_count} people remaining, {[len(cat) for cat in categories_out]} people per category')
+def usage_error(msg):
+    raise ValueError(msg)
 
-    return categories_out
 
+# Opt in counters for where a request spends its time. lap() adds the time since the last
+# lap to a phase, so the hot loop only pays for a clock read and a dict update per phase.
+# Failed tries are counted by reason, and conflicts by the family (roster line, from 0)
+# that caused them
+class Stats:
+    TOP_FAMILIES = 20
 
-def usage_error(msg):
-    raise ValueError(msg)
+    def __init__(self):
+        self.phases = {}
+        self.failures = {}
+        self.family_conflicts = {}
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def fail(self, reason, tries=1, families=()):
+        self.failures[reason] = self.failures.get(reason, 0) + tries
+        for fam in families:
+            self.family_conflicts[fam] = self.family_conflicts.get(fam, 0) + 1
+
+    def family_counts(self, families, counts):
+        for fam, count in zip(families, counts):
+            self.family_conflicts[fam] = self.family_conflicts.get(fam, 0) + count
+
+    # adds the counts from a worker's as_dict()
+    def merge(self, other):
+        for phase, seconds in other['phases'].items():
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        for reason, tries in other['failures'].items():
+            self.fail(reason, tries)
+        self.family_counts([int(fam) for fam in other['family_conflicts']], other['family_conflicts'].values())
+
+    def as_dict(self):
+        worst = sorted(self.family_conflicts.items(), key=lambda item: -item[1])[:self.TOP_FAMILIES]
+        return {'phases': dict(self.phases), 'failures': dict(self.failures),
+                'family_conflicts': {str(fam): count for fam, count in worst}}
+
+# stands in for Stats when they are off
+class NoStats:
+    def lap(self, phase):
+        pass
+
+    def fail(self, reason, tries=1, families=()):
+        pass
+
+    def family_counts(self, families, counts):
+        pass
+
+NO_STATS = NoStats()
+
+# deadline is the wall clock time (as from time.time) after which a request gives up, so
+# it still holds after waiting in a queue or being handed to another process
+def deadline_check(args):
+    if args.deadline is not None and time.time() > args.deadline:
+        usage_error('Ran out of time before creating valid teams')
 
 
 def dump_plan(args):
@@ -329,8 +2336,16 @@ def dump_plan(args):
     gen_msg = "compete" if args.generations else "spread out"
     lp(f'categories {gen_msg}')
 
+    if not args.oktogether:
+        lp(f'{args.engine} engine keeps family members apart')
+
     if not args.oktogether and args.verbose > 1:
         lp(f'maximum of {args.tries:,} tries to create valid teams')
+        if args.workers > 1:
+            lp(f'tries split across {args.workers} workers')
+
+    if args.seed is not None and args.verbose > 1:
+        lp(f'random seed {args.seed}')
 
     if args.verbose > 1:
         if args.json:
@@ -368,6 +2383,40 @@ def normalize_args(args):
     if args.round != 'closest' and args.uneven != True and args.teamsize:
         usage_error("Rounding option only applies when used with 'uneven' and 'teamsize'")
 
+    if args.cache_size <= 0:
+        usage_error('Cache size must be greater than 0')
+
+    if args.cache and args.workers > 1:
+        usage_error("Cannot cache results with more than 1 worker, which worker finds teams first is not repeatable")
+
+    if args.workers < 1:
+        usage_error('Number of workers must be at least 1')
+
+    if args.engine not in ENGINES:
+        usage_error(f"Unknown engine '{args.engine}', must be one of {', '.join(ENGINES)}")
+
+    if args.rounds < 1:
+        usage_error('Number of rounds must be at least 1')
+
+    if args.rounds > 1 and args.workers > 1:
+        usage_error('Rounds build on each other so they run in one process, cannot use more than 1 worker')
+
+    if args.balance and (args.workers > 1 or args.rounds > 1):
+        usage_error('Cannot balance ratings with more than 1 worker or round')
+
+    if args.time_limit is not None:
+        if args.time_limit <= 0:
+            usage_error('Time limit must be a positive number of seconds')
+        if args.workers > 1 or args.rounds > 1 or args.balance:
+            usage_error('Time limit applies to a single search, not more than 1 worker or round or balance')
+
+    if args.tries < 0 or (args.tries == 0 and args.time_limit is None):
+        usage_error('Number of tries must be at least 1, or 0 with a time limit for no limit on tries')
+
+# constructive places families directly, random is the original shuffle and reject search
+# and batch runs that same search many tries per numpy call
+ENGINES = ('constructive', 'random', 'batch')
+
 class Args:
     # init with default values
     def __init__(self):
@@ -382,6 +2431,19 @@ class Args:
         self.verbose = 0
         self.json = False
         self.separator = ''
+        self.engine = 'constructive'
+        self.workers = 1
+        self.seed = None
+        self.cache = None
+        self.cache_size = 64
+        self.compiled = False
+        self.deadline = None
+        self.stats = False
+        self.rounds = 1
+        self.balance = False
+        self.metadata = False
+        self.time_limit = None
+        self.division_teams = {}
 
 def default_args():
     return Args()
@@ -393,27 +2455,125 @@ if __name__ == "__main__":
     parser.add_argument('-g', '--generations', required=False, action='store_true', help='try to create teams from the same category (aka parents v kids)')
     parser.add_argument('-s', '--teamsize', required=False, default=-999, type=int, help='size of each team, must be more than 1 (default is 2)')
     parser.add_argument('-c', '--teamcount', required=False, default=-999, type=int, help='number of teams, must be more than 1')
-    parser.add_argument('-t', '--tries', required=False, default=10000, type=int, help='maximum number of attempts to create valid teams (default is 10,000)')
-    parser.add_argument('-d', '--drop', action='store_true', default=False, help='drop random extra people if teams are not even')
+    parser.add_argument('-t', '--tries', required=False, default=10000, type=int, help='maximum number of attempts to create valid teams, 0 for no limit with --time-limit (default is 10,000)')
+    parser.add_argument('-d', '--drop', action='store_true', default=False, help='drop extra people if teams are not even, from the largest families')
     parser.add_argument('-u', '--uneven', required=False, action='store_true', help='try to match team size, but allow uneven team sizes')
     parser.add_argument('-j', '--json', action='store_true', default=False, help='output in json')
     parser.add_argument('-r', '--round', default='closest', type=str, choices=['closest','down','up'], help='used with --uneven and --teamsize to round resulting number of teams down, up, or to closest even number (default is \'closest\')')
     parser.add_argument('-p', '--separator', required=False, default='', help="separator between team members in printout (default is ' - ')")
+    parser.add_argument('-e', '--engine', default='constructive', type=str, choices=ENGINES, help='how families are kept apart: place them directly, shuffle and retry, or shuffle and retry in batches (default is \'constructive\')')
+    parser.add_argument('-w', '--workers', required=False, default=1, type=int, help='number of processes searching for valid teams at once (default is 1)')
+    parser.add_argument('--seed', required=False, default=None, type=int, help='seed for random choices so the same request gives the same teams')
+    parser.add_argument('--cache', required=False, default=None, type=str, help='directory for caching results of seeded requests')
+    parser.add_argument('--cache-size', required=False, default=64, type=float, help='megabytes of results to keep in the cache (default is 64)')
+    parser.add_argument('--batch', required=False, action='store_true', help='family_file (or stdin) is json lines of jobs, each with a roster or file plus any options. Prints one json result per job, --workers runs jobs at once')
+    parser.add_argument('--serve', required=False, default=None, type=str, metavar='[HOST:]PORT', help='run as a local http service taking POST /teams jobs (as in --batch) on --workers processes')
+    parser.add_argument('--queue', required=False, default=16, type=int, help='requests the service accepts beyond --workers before answering 503 (default is 16)')
+    parser.add_argument('--request-timeout', required=False, default=30, type=float, help='seconds the service waits for teams before answering 504 (default is 30)')
+    parser.add_argument('--compiled', required=False, action='store_true', help='read family_file through a binary copy (family_file.hyc) that is rebuilt when the file changes')
+    parser.add_argument('--rounds', required=False, default=1, type=int, help='number of rounds of teams to create, keeping repeat teammates across rounds to a minimum (default is 1)')
+    parser.add_argument('--balance', required=False, action='store_true', help="even out the teams' rating totals, rosters give ratings after names like 'Ava Peters = 4.5'")
+    parser.add_argument('--stream', required=False, action='store_true', help='write each team as soon as it is made rather than all teams at the end, one json list per line with --json')
+    parser.add_argument('--output', required=False, default=None, type=str, help='file to write the teams to (default is stdout)')
+    parser.add_argument('--time-limit', required=False, default=None, type=float, help='seconds to search for valid teams, after which the try with the fewest family conflicts is returned marked as partial')
+    parser.add_argument('--division-size', required=False, default=[], action='append', metavar='DIVISION=SIZE', help='team size for one division of a roster with divisions, can be repeated')
+    parser.add_argument('--division-count', required=False, default=[], action='append', metavar='DIVISION=COUNT', help='team count for one division of a roster with divisions, can be repeated')
+    parser.add_argument('--metadata', required=False, action='store_true', help="with --json, print the whole result including each person's family and category, which --reteam reads")
+    parser.add_argument('--reteam', required=False, default=None, type=str, metavar='PREVIOUS', help='json result (from --json --metadata) to update: family_file lists people to add and --remove names to take out, moving as few people as possible')
+    parser.add_argument('--remove', required=False, default=None, type=str, metavar='NAMES_FILE', help='with --reteam, file of names to remove, one per line')
+    parser.add_argument('--stats', required=False, action='store_true', help='print time spent in each phase and counts of failed tries as json to stderr')
     parser.add_argument('-v', '--verbose', action="count", default=0, help='display more progress information')
+    parser.set_defaults(deadline=None)
     args = parser.parse_args()
+    args.division_teams = {}
+    for field, given in (('teamsize', args.division_size), ('teamcount', args.division_count)):
+        for setting in given:
+            name, _, value = setting.rpartition('=')
+            if not name or not value.strip().lstrip('-').isdigit() or name.strip() in args.division_teams:
+                parser.error(f'--division-size and --division-count take DIVISION=NUMBER once per division, not "{setting}"')
+            args.division_teams[name.strip()] = {field: int(value)}
+    if args.compiled and args.family_file is None:
+        parser.error('--compiled requires a family_file')
+    if args.compiled and args.batch:
+        parser.error("--compiled applies to each job in --batch, set 'compiled' in the job instead")
+
+    if args.serve is not None:
+        if args.queue < 0 or args.request_timeout <= 0 or args.workers < 1:
+            parser.error('--queue must be 0 or more, --request-timeout and --workers more than 0')
+        try:
+            serve(args.serve, args.workers, args.queue, args.request_timeout, args.verbose)
+        except KeyboardInterrupt as kint:
+            pass
+        sys.exit(0)
+
+    if args.stream and (args.batch or args.serve is not None):
+        parser.error('--stream applies to a single request, not --batch or --serve')
+    if args.metadata and (not args.json or args.stream):
+        parser.error('--metadata applies to --json output that is not streamed')
+    if args.remove is not None and args.reteam is None:
+        parser.error('--remove applies to --reteam')
+    if args.reteam is not None and (args.batch or args.stream or args.compiled):
+        parser.error('--reteam applies to a single request, not --batch, --stream or --compiled')
+    # re-teaming keeps the previous teams, so the options for making new ones don't apply
+    making = {'teamsize': '-s', 'teamcount': '-c', 'drop': '-d', 'uneven': '-u', 'round': '-r', 'rounds': '--rounds',
+              'balance': '--balance', 'time_limit': '--time-limit', 'division_size': '--division-size',
+              'division_count': '--division-count', 'stats': '--stats'}
+    if args.reteam is not None and any(getattr(args, field) != parser.get_default(field) for field in making):
+        parser.error(f"--reteam keeps the previous teams, so cannot be used with {', '.join(making.values())}")
+    if args.reteam is not None:
+        try:
+            with open(args.reteam, 'r') as previous_file:
+                previous = json.load(previous_file)
+            removed = []
+            if args.remove is not None:
+                with open(args.remove, 'r') as names:
+                    removed = [name.strip() for name in names if name.strip() and not name.strip().startswith('#')]
+        except OSError as oerr:
+            parser.error(f'cannot read "{oerr.filename}". {oerr.strerror}')
+        except ValueError as verr:
+            parser.error(f'cannot read "{args.reteam}". {verr}')
+
+    try:
+        out_file = open(args.output, 'w') if args.output else None
+    except OSError as oerr:
+        parser.error(f'cannot write to "{args.output}". {oerr.strerror}')
 
     open_file = None
     exit = 0
     try:
-        if args.family_file is None:
+        if args.compiled:
+            people = None
+        elif args.family_file is None and args.reteam is not None:
+            people = []
+        elif args.family_file is None:
             people = sys.stdin
         else:
             open_file = open(args.family_file, 'r')
             people = open_file
 
         try:
-            result = teams_from_list(args, people.readlines())
-            lp(result['teams'])
+            out = out_file or sys.stdout
+            if args.batch:
+                for result in run_batch(people, args.workers):
+                    print(json.dumps(result), file=out)
+            else:
+                if people is None:
+                    people = compiled_roster(args.family_file, verbose=args.verbose)
+                if args.stream:
+                    result = teams_from_list(args, people, out)
+                else:
+                    result = reteam(args, previous, people, removed) if args.reteam is not None else team_result(args, people)
+                    if args.metadata:
+                        print(json.dumps(result), file=out)
+                    else:
+                        print(ENCODERS['json' if args.json else 'text'](result['teams'], args), file=out)
+                    if args.reteam is not None:
+                        print(f"Added {result['added']}, removed {result['removed']} and moved {result['moved']}", file=sys.stderr)
+                if result.get('partial'):
+                    print(f"No valid teams within the time limit, family members share a team {len(result['conflicts'])} times: "
+                          + '; '.join(', '.join(names) for names in result['conflicts']), file=sys.stderr)
+                if args.stats:
+                    print(json.dumps(result['stats']), file=sys.stderr)
         except UnicodeDecodeError as uerr:
             lp(f'Could not read "{args.family_file}". Contains unreadable characters\n  hylat.py -h for help')
             exit = 1
@@ -423,6 +2583,9 @@ if __name__ == "__main__":
             exit = 2
         except KeyboardInterrupt as kint:
             exit = -1
+        except BrokenPipeError:
+            # whatever read the output (like head) stopped early, send the rest nowhere
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
 
     except Exception as ex:
 #        traceback.print_exc()
@@ -431,5 +2594,7 @@ if __name__ == "__main__":
     finally:
         if open_file is not None:
             open_file.close()
+        if out_file is not None:
+            out_file.close()
 
     sys.exit(exit)
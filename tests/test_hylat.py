@@ -23,7 +23,11 @@ SOFTWARE. """
 
 from context import hylat
 import pytest
+import asyncio
 import json
+import subprocess
+import sys
+import time
 import numpy as np
 
 
@@ -265,6 +269,637 @@ def test_default_json():
     members_start_with += [['Kid', 'Kid'] for _ in range(2)]
     results_helper(args, results, members_start_with, 0)
 
+def test_random_engine():
+    args = hylat.default_args()
+    args.teamsize = 2
+    args.engine = 'random'
+
+    with open('good_test1.txt', 'r') as people:
+        results = hylat.teams_from_list(args, people.readlines())
+
+    members_start_with = [['Parent', 'Kid'] for _ in range(7)]
+    members_start_with += [['Kid', 'Kid'] for _ in range(2)]
+    results_helper(args, results, members_start_with, 0)
+
+def test_batch_engine():
+    # this one can take 100+ tries
+    args = hylat.default_args()
+    args.teamsize = 6
+    args.engine = 'batch'
+
+    with open('good_test1.txt', 'r') as people:
+        results = hylat.teams_from_list(args, people.readlines())
+
+    members_start_with = [['Parent', 'Parent', 'Kid', 'Kid', 'Kid', 'Kid'] for _ in range(2)]
+    members_start_with += [['Parent', 'Parent', 'Parent', 'Kid', 'Kid', 'Kid'] for _ in range(1)]
+    results_helper(args, results, members_start_with, 0)
+
+def test_batch_engine_drop_gen():
+    args = hylat.default_args()
+    args.teamsize = 4
+    args.drop = True
+    args.generations = True
+    args.engine = 'batch'
+
+    with open('good_test1.txt', 'r') as people:
+        results = hylat.teams_from_list(args, people.readlines())
+
+    members_start_with = [['*', '*', '*', '*'] for _ in range(4)]
+    results_helper(args, results, members_start_with, 2)
+
+def test_workers():
+    args = hylat.default_args()
+    args.teamsize = 6
+    args.engine = 'random'
+    args.workers = 3
+
+    with open('good_test1.txt', 'r') as people:
+        results = hylat.teams_from_list(args, people.readlines())
+
+    members_start_with = [['Parent', 'Parent', 'Kid', 'Kid', 'Kid', 'Kid'] for _ in range(2)]
+    members_start_with += [['Parent', 'Parent', 'Parent', 'Kid', 'Kid', 'Kid'] for _ in range(1)]
+    results_helper(args, results, members_start_with, 0)
+
+def test_fail_workers_tries():
+    # every family fills all 8 teams, which random shuffles (and the repair after each) only
+    # rarely solve. Seeded so that neither worker does, and both use up their share of the tries
+    args = hylat.default_args()
+    args.teamcount = 8
+    args.engine = 'random'
+    args.workers = 2
+    args.tries = 41
+    args.seed = 0
+
+    lines = [', '.join(f'Kid_{k}_{f}' for k in range(4)) + ' : ' + ', '.join(f'Parent_{p}_{f}' for p in range(4)) for f in range(8)]
+    with pytest.raises(ValueError, match='in 41 attempts'):
+        results = hylat.teams_from_list(args, lines)
+
+def test_seed():
+    for engine in hylat.ENGINES:
+        teams = []
+        for _ in range(2):
+            args = hylat.default_args()
+            args.teamsize = 4
+            args.drop = True
+            args.engine = engine
+            args.seed = 1234
+
+            with open('good_test1.txt', 'r') as people:
+                teams.append(hylat.teams_from_list(args, people.readlines())['teams'])
+
+        assert teams[0] == teams[1]
+
+def test_cache(tmp_path):
+    args = hylat.default_args()
+    args.teamsize = 2
+    args.seed = 7
+    args.cache = str(tmp_path)
+
+    with open('good_test1.txt', 'r') as people:
+        lines = people.readlines()
+
+    results = hylat.teams_from_list(args, lines)
+    cached = list(tmp_path.glob('*.json'))
+    assert len(cached) == 1
+
+    # changes to comments and spacing do not change the key, so this must come from the cache
+    # the cache holds the teams as lists, they are only encoded on the way out
+    cached[0].write_text(json.dumps(dict(json.loads(cached[0].read_text()), tries=-1)))
+    results2 = hylat.teams_from_list(args, ['# comment\n'] + [' ' + l for l in lines])
+    assert results2 == dict(results, tries=-1)
+
+    args.teamcount = 3
+    args.teamsize = -999
+    results3 = hylat.teams_from_list(args, lines)
+    assert results3['team_count'] == 3
+    assert len(list(tmp_path.glob('*.json'))) == 2
+
+def test_fail_cache_workers(tmp_path):
+    args = hylat.default_args()
+    args.teamsize = 2
+    args.seed = 7
+    args.workers = 2
+    args.cache = str(tmp_path)
+
+    with open('good_test1.txt', 'r') as people:
+        with pytest.raises(ValueError):
+            hylat.teams_from_list(args, people)
+
+def test_cache_evict(tmp_path):
+    cache = hylat.ResultCache(str(tmp_path), 300 / (1024 * 1024))
+    for key in ('a', 'b', 'c', 'd'):
+        cache.put(key, {'teams': 'x' * 100})
+
+    assert cache.get('a') is None
+    assert cache.get('d') == {'teams': 'x' * 100}
+    assert len(list(tmp_path.glob('*.json'))) == 2
+
+def test_compiled(tmp_path):
+    source = tmp_path / 'people.txt'
+    with open('good_testE1.txt', 'r') as people:
+        source.write_text(people.read())
+
+    roster = hylat.compiled_roster(str(source))
+    assert (tmp_path / 'people.txt.hyc' / 'source.json').exists()
+
+    # second use is memory-mapped from the compiled copy
+    roster = hylat.compiled_roster(str(source))
+    assert isinstance(roster.family, np.memmap)
+    assert len(roster) == 20
+    assert [len(cat) for cat in roster.categories()] == [7, 11, 2]
+    assert roster.team_names(roster.categories()[2]) == ['Extra_1_8', 'Extra_2_9']
+
+    args = hylat.default_args()
+    args.teamsize = 2
+    results = hylat.teams_from_list(args, roster)
+    members_start_with = [['Parent', 'Kid'] for _ in range(7)]
+    members_start_with += [['Kid', 'Extra'] for _ in range(2)]
+    members_start_with += [['Kid', 'Kid'] for _ in range(1)]
+    results_helper(args, results, members_start_with, 0)
+
+    # editing the text recompiles it
+    source.write_text(source.read_text() + 'Kid_Z_10\n')
+    assert len(hylat.compiled_roster(str(source))) == 21
+    assert hylat.compiled_roster(str(source)).rating is None
+
+    # ratings are a column of their own
+    source.write_text(source.read_text() + 'Kid_Y_11 = 2.5\n')
+    roster = hylat.compiled_roster(str(source))
+    assert np.isnan(roster.rating[0]) and roster.rating[21] == 2.5
+    assert hylat.compiled_roster(str(source)).rating[21] == 2.5
+
+    # names are looked up in bulk straight from the mapped blob, and the cache key hashes
+    # their bytes rather than decoding them
+    roster = hylat.compiled_roster(str(source))
+    assert isinstance(roster.names.blob, np.memmap)
+    assert roster.names.lookup([21, 0, 21]) == [roster.names[21], roster.names[0], 'Kid_Y_11']
+    assert roster.digest() == hylat.compiled_roster(str(source)).digest()
+    assert roster.digest() != roster.take(np.arange(21)).digest()
+
+def test_names():
+    buffers = hylat.read_roster(['Zoë, Ann : Bö = 3\n', '\n', 'Åsa\n'])
+    roster = buffers.columns()
+    for table, rows in ((buffers.names, [3, 0, 2, 1]), (roster.names, np.array([3, 0, 2, 1]))):
+        assert table.lookup(rows) == ['Åsa', 'Zoë', 'Bö', 'Ann']
+        assert table.lookup([]) == []
+    assert roster.team_names(np.array([2, 3])) == ['Bö', 'Åsa']
+
+def test_batch():
+    jobs = [json.dumps({'id': 1, 'file': 'good_test1.txt', 'teamsize': 2}),
+            '',
+            json.dumps({'id': 2, 'roster': 'A_1_1, B_1_1\nA_2_2\nB_3_3', 'teamcount': 2}),
+            json.dumps({'id': 3, 'file': 'good_test1.txt', 'teamsize': 4}),
+            json.dumps({'file': 'good_test1.txt', 'bogus': 1}),
+            'not json',
+            json.dumps({'id': 6, 'file': 'good_test1.txt', 'teamcount': '2'}),
+            json.dumps({'id': 7, 'file': 'good_test1.txt', 'teamsize': 2, 'verbose': 2, 'seed': None})]
+
+    for workers in (1, 2):
+        results = list(hylat.run_batch(jobs, workers))
+        assert len(results) == 7
+        assert results[0]['id'] == 1 and results[0]['team_count'] == 9
+        assert results[1]['id'] == 2 and len(results[1]['teams']) == 2
+        assert results[2]['id'] == 3 and 'exactly 4' in results[2]['error']
+        assert 'bogus' in results[3]['error']
+        assert 'Could not read job' in results[4]['error']
+        assert results[5]['id'] == 6 and 'teamcount' in results[5]['error']
+        assert results[6]['id'] == 7 and results[6]['team_count'] == 9
+
+    # results are always json, so the output options are refused rather than ignored
+    for field in ({'json': True}, {'separator': 'x'}, {'json': True, 'separator': 'x'}):
+        result = hylat.job_result(dict({'roster': 'A\nB', 'teamcount': 2}, **field))
+        assert 'always json' in result['error']
+
+def test_service():
+    async def request(port, method, path, body=b''):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        head, _, payload = response.partition(b'\r\n\r\n')
+        return int(head.split()[1]), json.loads(payload)
+
+    async def run():
+        service = hylat.TeamService(1, 0, 10)
+        server = await service.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            job = {'id': 4, 'roster': 'A_1_1, B_1_1\nA_2_2\nB_3_3', 'teamcount': 2}
+            status, result = await request(port, 'POST', '/teams', json.dumps(job).encode())
+            assert status == 200 and result['id'] == 4 and result['team_count'] == 2
+
+            for field in ({'file': 'good_test1.txt'}, {'cache': '/tmp'}, {'workers': 4}, {'verbose': 1}, {'json': True}):
+                status, result = await request(port, 'POST', '/teams', json.dumps(dict(job, **field)).encode())
+                assert status == 400 and 'not allowed' in result['error']
+
+            status, result = await request(port, 'GET', '/teams')
+            assert status == 405
+
+            status, metrics = await request(port, 'GET', '/metrics')
+            assert status == 200
+            assert metrics['statuses'] == {'200': 1, '400': 5, '405': 1}
+            assert metrics['requests'] == 7
+
+            # a dead worker breaks the pool, that request fails and the next gets a new pool
+            broken = service.pool
+            for process in list(broken._processes.values()):
+                process.kill()
+            while not broken._broken:
+                await asyncio.sleep(0.01)
+            status, result = await request(port, 'POST', '/teams', json.dumps(job).encode())
+            assert status == 500 and 'stopped' in result['error']
+            assert service.pool is not broken
+            status, result = await request(port, 'POST', '/teams', json.dumps(job).encode())
+            assert status == 200 and result['team_count'] == 2
+            status, metrics = await request(port, 'GET', '/metrics')
+            assert metrics['in_flight'] == 0
+        finally:
+            server.close()
+            service.stop()
+
+    asyncio.run(run())
+
+def test_fail_deadline():
+    args = hylat.default_args()
+    args.teamsize = 2
+    args.deadline = time.time() - 1
+
+    with open('good_test1.txt', 'r') as people:
+        with pytest.raises(ValueError, match='out of time'):
+            hylat.teams_from_list(args, people)
+
+def test_small_no_numpy():
+    # small rosters are teamed without importing numpy
+    code = ('import sys; sys.path.insert(0, ".."); import hylat; args = hylat.default_args(); args.teamsize = 2; '
+            'hylat.teams_from_list(args, open("good_test1.txt")); print("numpy" in sys.modules)')
+    assert subprocess.run([sys.executable, '-c', code], capture_output=True, text=True).stdout.strip() == 'False'
+
+def test_small_threshold(monkeypatch):
+    # same teams shape from the plain python and numpy searches
+    for threshold in (0, hylat.SMALL_ROSTER):
+        monkeypatch.setattr(hylat, 'SMALL_ROSTER', threshold)
+        args = hylat.default_args()
+        args.teamsize = 4
+        args.uneven = True
+        args.round = 'up'
+        with open('good_test1.txt', 'r') as people:
+            results = hylat.teams_from_list(args, people)
+
+        members_start_with = [['Parent', 'Kid', 'Kid', 'Kid'] for _ in range(1)]
+        members_start_with += [['Parent', 'Parent', 'Kid', 'Kid'] for _ in range(2)]
+        members_start_with += [['Parent', 'Kid', 'Kid'] for _ in range(2)]
+        results_helper(args, results, members_start_with, 0)
+
+def test_slot_layout():
+    # first category overflows 3 teams, its extra person is pushed to the end of the second
+    assert hylat.slot_layout([4, 2], 3, False) == [[0, 1, 2, 2], [0, 1]]
+    assert hylat.slot_layout([4, 2], 3, True) == [[0, 0, 1, 1], [2, 2]]
+
+def test_bench_roster():
+    from benchmarks.roster import roster_lines
+
+    for families in ('fixed', 'uniform', 'geometric'):
+        lines = list(roster_lines(1000, distribution=families, category_count=3, skew=1.0, seed=2))
+        roster = hylat.parse_roster(lines)
+        assert len(roster) == 1000
+        assert roster.family_sizes.min() > 0
+        sizes = [len(cat) for cat in roster.categories()]
+        assert sizes[0] > sizes[1] > sizes[2]
+
+    assert lines == list(roster_lines(1000, distribution=families, category_count=3, skew=1.0, seed=2))
+
+def test_rounds(monkeypatch):
+    from benchmarks.roster import roster_lines
+    from collections import Counter
+    from itertools import combinations
+
+    lines = list(roster_lines(200, distribution='geometric', category_count=2, seed=1))
+    roster = hylat.parse_roster(lines)
+    family_of = {roster.names[n]: int(f) for n, f in zip(roster.name.tolist(), roster.family)}
+
+    # both the dense and the sparse pair counts
+    for dense in (hylat.DENSE_PAIRS, 0):
+        monkeypatch.setattr(hylat, 'DENSE_PAIRS', dense)
+        args = hylat.default_args()
+        args.teamsize = 4
+        args.rounds = 10
+        args.json = True
+        args.seed = 1
+        results = hylat.teams_from_list(args, lines)
+        rounds = json.loads(results['teams'])
+        assert len(rounds) == results['rounds'] == 10
+        assert results['tries'] >= 10
+
+        met = Counter()
+        for teams in rounds:
+            assert sorted(name for team in teams for name in team) == sorted(family_of)
+            for team in teams:
+                assert len(team) == 4
+                assert len({family_of[name] for name in team}) == 4
+                met.update(combinations(sorted(team), 2))
+        assert results['repeats'] == sum(count - 1 for count in met.values())
+        # 10 random rounds of 50 teams would repeat about 30 pairs
+        assert results['repeats'] < 5
+
+    args = hylat.default_args()
+    args.teamcount = 4
+    args.drop = True
+    args.rounds = 3
+    with open('good_test1.txt', 'r') as people:
+        results = hylat.teams_from_list(args, people)
+    assert [len(r.splitlines()) for r in results['teams'].split('\n\n')] == [4, 4, 4]
+
+    args.workers = 2
+    with pytest.raises(ValueError):
+        hylat.teams_from_list(args, ['A', 'B'])
+
+def test_ratings():
+    roster = hylat.parse_roster(['Ann, Bob = 3', 'Cy = 2.5 : Dee'])
+    assert roster.team_names(np.arange(4)) == ['Ann', 'Bob', 'Cy', 'Dee']
+    assert np.isnan(roster.rating[[0, 3]]).all() and roster.rating[1:3].tolist() == [3, 2.5]
+    assert hylat.parse_roster(['Ann', 'Bob']).rating is None
+    for bad in ('Ann = good', '= 4', 'Ann = inf'):
+        with pytest.raises(ValueError):
+            hylat.parse_roster([bad])
+
+def test_balance():
+    import random
+    from benchmarks.roster import roster_lines
+
+    rnd = random.Random(1)
+    lines = []
+    for line in roster_lines(400, distribution='geometric', category_count=2, seed=1):
+        lines.append(':'.join(', '.join(f'{name.strip()} = {rnd.randint(1, 100)}' for name in cat.split(',') if name.strip())
+                              for cat in line.split(':')))
+    roster = hylat.parse_roster(lines)
+    rating = {roster.names[n]: r for n, r in zip(roster.name.tolist(), roster.rating.tolist())}
+    family = {roster.names[n]: f for n, f in zip(roster.name.tolist(), roster.family.tolist())}
+    category = {roster.names[n]: c for n, c in zip(roster.name.tolist(), roster.category.tolist())}
+
+    results = {}
+    for balance in (False, True):
+        args = hylat.default_args()
+        args.teamsize = 4
+        args.json = True
+        args.seed = 1
+        args.balance = balance
+        results[balance] = hylat.teams_from_list(args, lines)
+    plain = json.loads(results[False]['teams'])
+    results = results[True]
+    teams = json.loads(results['teams'])
+
+    totals = [sum(rating[name] for name in team) for team in teams]
+    assert results['spread'] == max(totals) - min(totals)
+    plain_totals = [sum(rating[name] for name in team) for team in plain]
+    assert results['spread'] < (max(plain_totals) - min(plain_totals)) / 10
+    assert all(len({family[name] for name in team}) == len(team) for team in teams)
+    # the same mix of categories per team as without balancing
+    mix = lambda teams: sorted(sorted(category[name] for name in team) for team in teams)
+    assert mix(teams) == mix(plain)
+
+    args = hylat.default_args()
+    args.balance = True
+    with pytest.raises(ValueError, match='needs ratings'):
+        hylat.teams_from_list(args, ['A', 'B'])
+
+def test_stream():
+    import io
+
+    for use_json in (False, True):
+        for rounds in (1, 3):
+            results = {}
+            for stream in (False, True):
+                args = hylat.default_args()
+                args.teamsize = 2
+                args.json = use_json
+                args.rounds = rounds
+                args.seed = 2
+                out = io.StringIO() if stream else None
+                with open('good_test1.txt', 'r') as people:
+                    results[stream] = hylat.teams_from_list(args, people, out)
+                if stream:
+                    streamed = out.getvalue()
+
+            assert 'teams' not in results[True]
+            expected = results[False]['teams']
+            if not use_json:
+                assert streamed == expected + '\n'
+            elif rounds == 1:
+                assert [json.loads(line) for line in streamed.splitlines()] == json.loads(expected)
+            else:
+                lines = [json.loads(line) for line in streamed.splitlines()]
+                assert [[line['team'] for line in lines if line['round'] == r + 1] for r in range(rounds)] == json.loads(expected)
+
+def test_team_result():
+    args = hylat.default_args()
+    args.teamsize = 4
+    args.seed = 4
+    args.metadata = True
+    with open('good_testE1.txt', 'r') as people:
+        results = hylat.team_result(args, people)
+
+    teams = results['teams']
+    assert sorted(name for team in teams for name in team) == sorted(
+        name.strip() for line in open('good_testE1.txt') for cat in line.split(':') for name in cat.split(',') if name.strip())
+    assert [len(team) for team in results['families']] == [len(team) for team in teams]
+    for team, families, categories in zip(teams, results['families'], results['categories']):
+        assert len(set(families)) == len(families)
+        assert categories == sorted(categories)
+        assert all(name.startswith(('Parent', 'Kid', 'Extra')[c]) for name, c in zip(team, categories))
+
+    # encoded once, by whichever encoder is asked for
+    args.metadata = False
+    with open('good_testE1.txt', 'r') as people:
+        encoded = hylat.teams_from_list(args, people, encoder=lambda teams, args: len(teams))
+    assert encoded['teams'] == len(teams)
+
+def test_time_limit():
+    roster = hylat.parse_roster(open('good_testE3.txt'))
+    family = {roster.names[n]: f for n, f in zip(roster.name.tolist(), roster.family.tolist())}
+
+    for engine in hylat.ENGINES:
+        # one try is seldom enough for these, so the best one comes back with its conflicts
+        args = hylat.default_args()
+        args.teamsize = 4
+        args.engine = engine
+        args.tries = 1
+        args.time_limit = 5
+        args.seed = 1
+        args.json = True
+        results = hylat.teams_from_list(args, open('good_testE3.txt'))
+        assert results['partial'] and results['tries'] == 1
+        teams = json.loads(results['teams'])
+        assert sorted(len(team) for team in teams) == [4] * len(teams)
+        shared = []
+        for team in teams:
+            for fam in set(family[name] for name in team):
+                names = [name for name in team if family[name] == fam]
+                if len(names) > 1:
+                    shared.append(sorted(names))
+        assert sorted(shared) == sorted(sorted(names) for names in results['conflicts'])
+
+        # with no limit on tries the time limit is the only budget
+        args = hylat.default_args()
+        args.teamsize = 4
+        args.engine = engine
+        args.tries = 0
+        args.time_limit = 5
+        results = hylat.teams_from_list(args, open('good_testE3.txt'))
+        assert 'partial' not in results
+
+    args = hylat.default_args()
+    args.tries = 0
+    with pytest.raises(ValueError, match='tries'):
+        hylat.teams_from_list(args, open('good_testE3.txt'))
+
+def test_reteam():
+    args = hylat.default_args()
+    args.teamsize = 4
+    args.seed = 3
+    args.metadata = True
+    with open('good_testE3.txt', 'r') as people:
+        previous = hylat.team_result(args, people)
+    before = json.loads(json.dumps(previous))
+
+    gone = previous['teams'][0][:3] + previous['teams'][1][:1]
+    kin = previous['teams'][4][0]
+    results = hylat.reteam(hylat.default_args(), previous, ['Late_1, Late_2 : Late_3', 'Solo', f'{kin}, Kin_1'], gone)
+    assert previous == before
+    assert results['added'] == 5 and results['removed'] == 4
+    assert results['player_count'] == 25
+
+    teams = results['teams']
+    names = [name for team in teams for name in team]
+    assert sorted(names) == sorted([name for team in before['teams'] for name in team if name not in gone]
+                                   + ['Late_1', 'Late_2', 'Late_3', 'Solo', 'Kin_1'])
+    assert max(len(team) for team in teams) - min(len(team) for team in teams) <= 1
+    for team, families, categories in zip(teams, results['families'], results['categories']):
+        assert len(team) == len(families) == len(categories)
+        assert len(set(families)) == len(families)
+        assert categories == sorted(categories)
+    family = {name: fam for team, fams in zip(teams, results['families']) for name, fam in zip(team, fams)}
+    assert family['Late_1'] == family['Late_2'] == family['Late_3'] != family['Solo']
+    assert family['Kin_1'] == family[kin]
+
+    old_team = {name: t_num for t_num, team in enumerate(before['teams']) for name in team}
+    assert results['moved'] == sum(1 for t_num, team in enumerate(teams) for name in team
+                                   if name in old_team and old_team[name] != t_num)
+    assert results['moved'] <= 1
+
+    # the result can be edited again, and removing everyone who was added gives back the sizes
+    again = hylat.reteam(hylat.default_args(), results, [], ['Late_1', 'Late_2', 'Late_3', 'Solo', 'Kin_1'])
+    assert again['player_count'] == 20
+
+    with pytest.raises(ValueError, match='metadata'):
+        hylat.reteam(hylat.default_args(), {'teams': before['teams']}, [], [])
+    with pytest.raises(ValueError, match='not on any team'):
+        hylat.reteam(hylat.default_args(), before, [], ['Nobody'])
+
+def test_divisions():
+    lines = ['# two pools\n']
+    with open('good_testE1.txt', 'r') as people:
+        lines += ['[Kids] ' + line for line in people if line.strip()]
+    with open('good_test1.txt', 'r') as people:
+        lines += [' [Adults]' + line for line in people if line.strip()]
+
+    results = {}
+    for workers in (1, 2):
+        args = hylat.default_args()
+        args.teamsize = 2
+        args.division_teams = {'Kids': {'teamcount': 4}}
+        args.seed = 5
+        args.workers = workers
+        results[workers] = hylat.team_result(args, lines)
+    assert results[1] == results[2]
+    results = results[1]
+
+    assert list(results['teams']) == ['Kids', 'Adults']
+    assert len(results['teams']['Kids']) == 4
+    assert all(len(team) == 2 for team in results['teams']['Adults'])
+    assert results['divisions']['Kids']['team_count'] == 4
+    assert results['team_count'] == 4 + len(results['teams']['Adults'])
+    assert results['player_count'] == 20 + sum(len(team) for team in results['teams']['Adults'])
+
+    # workers spread divisions, so options that need a single process still apply to each
+    results = {}
+    for workers in (1, 2):
+        args = hylat.default_args()
+        args.teamsize = 2
+        args.division_teams = {'Kids': {'teamcount': 4}}
+        args.seed = 5
+        args.rounds = 2
+        args.workers = workers
+        results[workers] = hylat.team_result(args, lines)
+    assert results[1] == results[2]
+    assert len(results[1]['teams']['Kids']) == 2
+    args.rounds = 1
+    args.time_limit = 5
+    assert hylat.team_result(args, lines)['divisions']['Kids']['team_count'] == 4
+
+    args = hylat.default_args()
+    args.teamsize = 2
+    args.seed = 5
+    text = hylat.teams_from_list(args, lines)['teams']
+    assert text.startswith('[Kids]\n') and '\n\n[Adults]\n' in text
+
+    args = hylat.default_args()
+    args.division_teams = {'Teens': {'teamsize': 2}}
+    with pytest.raises(ValueError, match='No division named Teens'):
+        hylat.team_result(args, lines)
+    args = hylat.default_args()
+    args.teamsize = 3
+    with pytest.raises(ValueError, match='^Division Kids:'):
+        hylat.team_result(args, lines)
+    with pytest.raises(ValueError, match='needs a division'):
+        hylat.team_result(hylat.default_args(), lines + ['Extra_Person\n'])
+    with pytest.raises(ValueError, match='first line'):
+        hylat.team_result(hylat.default_args(), ['Ann, Bob\n', '[Kids] Cal\n'])
+
+def test_stats():
+    for engine in hylat.ENGINES:
+        args = hylat.default_args()
+        args.teamsize = 4
+        args.drop = True
+        args.engine = engine
+        args.tries = 400
+        args.stats = True
+
+        with open('good_test1.txt', 'r') as people:
+            results = hylat.teams_from_list(args, people)
+
+        stats = results['stats']
+        assert stats['phases']['parse'] >= 0 and stats['phases']['output'] >= 0
+        assert 'drop' in stats['phases']
+        assert sum(stats['failures'].values()) == results['tries'] - 1
+        assert json.loads(json.dumps(stats)) == stats
+
+    args = hylat.default_args()
+    args.teamsize = 2
+    with open('good_test1.txt', 'r') as people:
+        assert 'stats' not in hylat.teams_from_list(args, people)
+
+def test_constructive_full_families():
+    # every family is as large as the team count, which random shuffles almost never solve
+    args = hylat.default_args()
+    args.teamcount = 8
+    args.tries = 20
+
+    lines = [', '.join(f'Kid_{k}_{f}' for k in range(4)) + ' : ' + ', '.join(f'Parent_{p}_{f}' for p in range(4)) for f in range(8)]
+    results = hylat.teams_from_list(args, lines)
+
+    members_start_with = [['Kid']*4 + ['Parent']*4 for _ in range(8)]
+    results_helper(args, results, members_start_with, 0)
+
+def test_fail_engine():
+    args = hylat.default_args()
+    args.teamsize = 2
+    args.engine = 'psychic'
+
+    with open('good_test1.txt', 'r') as people:
+        with pytest.raises(ValueError):
+            results = hylat.teams_from_list(args, people.readlines())
+
 def test_teamcount3():
     args = hylat.default_args()
     args.teamcount = 3
@@ -530,6 +1165,55 @@ def test_small_drop():
     results_helper(args, results, members_start_with, 1)
 
 
+def test_drop_planned(monkeypatch):
+    # the big family has one person too many for 3 teams, so that is who is dropped, always
+    # in one go and from both the plain python and numpy paths
+    lines = ['Big_1, Big_2, Big_3, Big_4', 'A_1, A_2', 'B_1', 'C_1', 'D_1', 'E_1']
+    for threshold in (0, hylat.SMALL_ROSTER):
+        monkeypatch.setattr(hylat, 'SMALL_ROSTER', threshold)
+        for seed in range(10):
+            args = hylat.default_args()
+            args.teamcount = 3
+            args.drop = True
+            args.json = True
+            args.seed = seed
+            results = hylat.teams_from_list(args, lines)
+
+            teams = json.loads(results['teams'])
+            assert results['drop_count'] == 1 and results['tries'] == 1
+            assert sorted(len(team) for team in teams) == [3, 3, 3]
+            assert sum(name.startswith('Big') for team in teams for name in team) == 3
+            assert all(sum(name.startswith('Big') for name in team) == 1 for team in teams)
+
+def test_repair():
+    from benchmarks.roster import roster_lines
+
+    lines = list(roster_lines(2000, distribution='geometric', category_count=2, seed=1))
+    for engine in ('random', 'batch'):
+        args = hylat.default_args()
+        args.teamsize = 4
+        args.engine = engine
+        args.json = True
+        args.seed = 1
+        results = hylat.teams_from_list(args, lines)
+        if engine == 'random':
+            assert results['tries'] == 1 and results['repairs'] > 0
+
+        roster = hylat.read_roster(lines).columns()
+        family_of = {roster.names[n]: int(f) for n, f in zip(roster.name.tolist(), roster.family)}
+        teams = json.loads(results['teams'])
+        assert all(len(team) == 4 for team in teams)
+        assert all(len({family_of[name] for name in team}) == 4 for team in teams)
+
+    # the unshuffled layout puts both A's on the first team and both B's on the second,
+    # one swap fixes both
+    roster = hylat.read_roster(['A_1, A_2', 'B_1, B_2']).columns()
+    layout = hylat.team_layout(roster, roster.categories(), 2, True)
+    people = layout[0].copy()
+    assert len(hylat.find_conflicts(layout[1], roster.family[people])[0]) == 2
+    assert hylat.repair_conflicts(roster, layout, people, np.random.default_rng(1)) == 1
+    assert len(hylat.find_conflicts(layout[1], roster.family[people])[0]) == 0
+
 def test_drop_teamcount():
     args = hylat.default_args()
     args.teamcount = 4
@@ -551,6 +1235,106 @@ def test_fail_noteven():
             results = hylat.teams_from_list(args, people.readlines())
 
 
+def test_fail_infeasible(monkeypatch):
+    # with generations the kids all land on the second team, where Al and Amy would meet.
+    # Both paths say so up front instead of running out of tries
+    lines = [': Al, Amy', 'Ann : Bo', 'Bob', 'Cy']
+    for threshold in (0, hylat.SMALL_ROSTER):
+        monkeypatch.setattr(hylat, 'SMALL_ROSTER', threshold)
+        args = hylat.default_args()
+        args.teamcount = 2
+        args.generations = True
+        args.tries = 10 ** 9
+        with pytest.raises(ValueError, match='No valid teams exist: category 2 .* family of Al'):
+            hylat.teams_from_list(args, lines)
+
+        # the check lets the same roster through when categories are spread out
+        args.generations = False
+        assert hylat.teams_from_list(args, lines)['team_count'] == 2
+
+# families of up to 3 in three categories, 30 people in teams of 4 with 2 to drop
+DROP_ROSTER = [
+    '', ' : P0_1_1, P1_1_1 : P2_2_1, P3_2_1', ' :  : P4_2_2, P5_2_2, P6_2_2', 'P7_0_3 : P8_1_3 : ',
+    'P9_0_4, P10_0_4 : P11_1_4 : P12_2_4', ' : P13_1_5, P14_1_5, P15_1_5 : ', 'P16_0_6 :  : P17_2_6, P18_2_6', '',
+    ' : P19_1_8, P20_1_8, P21_1_8 : ', 'P22_0_9 : P23_1_9 : P24_2_9',
+    'P25_0_10, P26_0_10, P27_0_10 : P28_1_10, P29_1_10 : ']
+
+def test_drop_replans():
+    # capping the largest families can leave a category that no longer fits its slots.
+    # Another choice of drops is made then, and the message never says no teams exist
+    for engine in ('constructive', 'random'):
+        for seed in range(30):
+            args = hylat.default_args()
+            args.teamsize = 4
+            args.drop = True
+            args.generations = True
+            args.engine = engine
+            args.seed = seed
+            assert hylat.team_result(args, DROP_ROSTER)['team_count'] == 7
+
+    # every choice keeps two of the family of three on the one team of kids
+    args = hylat.default_args()
+    args.teamcount = 2
+    args.drop = True
+    args.generations = True
+    with pytest.raises(ValueError, match='The people chosen to drop leave no valid teams in 16 choices'):
+        hylat.team_result(args, [': Al, Amy, Ann', 'Bob', 'Cy', 'Dee', 'Eve'])
+
+
+def test_gale_ryser():
+    # two families of 2 and one of 1 fill teams of 3 and 2
+    assert hylat.gale_ryser({2: 2, 1: 1}, [3, 2]) is None
+    # but not a single team of 3, which only takes one of each
+    assert hylat.gale_ryser({2: 1, 1: 1}, [3]) == (3, 1, 2)
+    # nor two teams of 2 when one family has 3
+    assert hylat.gale_ryser({3: 1, 1: 1}, [2, 2]) == (4, 2, 3)
+
+
+def test_roster_columns():
+    with open('good_testE1.txt', 'r') as people:
+        roster = hylat.parse_roster(people.readlines())
+
+    assert roster.family.dtype == np.int32
+    assert roster.category.dtype == np.int16
+    assert roster.name.dtype == np.int32
+    assert len(roster) == 20
+    assert roster.category_count == 3
+    assert [len(cat) for cat in roster.categories()] == [7, 11, 2]
+    # line with only whitespace categories is still a (empty) family
+    assert roster.family_sizes.tolist() == [2, 3, 3, 2, 0, 1, 1, 1, 4, 3]
+    assert roster.team_names(roster.categories()[2]) == ['Extra_1_8', 'Extra_2_9']
+
+
+def test_roster_stream():
+    with open('good_testE1.txt', 'r') as people:
+        text = people.read()
+        people.seek(0)
+        streamed = hylat.parse_roster(people)
+
+    assert list(hylat.iter_lines(text)) == text.splitlines()
+    from_str = hylat.parse_roster(hylat.iter_lines(text))
+    for roster in (streamed, from_str):
+        assert roster.family_sizes.tolist() == [2, 3, 3, 2, 0, 1, 1, 1, 4, 3]
+        assert roster.team_names(roster.categories()[2]) == ['Extra_1_8', 'Extra_2_9']
+
+    # the same line breaks as splitlines, not just newlines
+    for text in ('A\rB\rC\rD', 'A\r\nB\x1cC\u2028D\n', 'A\v\fB\x85\n'):
+        assert list(hylat.iter_lines(text)) == text.splitlines()
+    assert hylat.teams_from_str(hylat.default_args(), 'A\rB\rC\rD')['team_count'] == 2
+
+
+def test_find_conflicts():
+    team_ids = np.array([0, 0, 0, 1, 1, 2, 2, 2, 2], dtype=np.int32)
+    family_ids = np.array([5, 1, 5, 1, 2, 3, 3, 3, 4], dtype=np.int32)
+
+    teams, families = hylat.find_conflicts(team_ids, family_ids)
+    assert teams.tolist() == [0, 2]
+    assert families.tolist() == [5, 3]
+
+    teams, families = hylat.find_conflicts(team_ids, np.arange(9, dtype=np.int32))
+    assert len(teams) == 0 and len(families) == 0
+
+
 def test_fail_input():
     for fname in ('bad_test4.txt', 'bad_test6.txt'):
         do_fail_input(fname)